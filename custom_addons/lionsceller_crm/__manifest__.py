@@ -10,18 +10,32 @@
         - Auto-assign Salespersons
         - Automated reminders
     """,
-    'depends': ['crm', 'base_automation', 'sale', 'product', 'stock'],
+    'depends': ['crm', 'base_automation', 'sale', 'product', 'stock', 'purchase'],
+    'external_dependencies': {
+        'python': ['numpy'],
+    },
     'data': [
         'security/ir.model.access.csv',
         'views/res_config_settings_views.xml',
         'views/res_partner_views.xml',
+        'views/res_users_views.xml',
         'views/crm_lead_views.xml',
         'views/product_trend_report_views.xml',
+        'views/product_sales_forecast_views.xml',
         'views/stock_minmax_report_views.xml',
+        'views/stock_replenishment_param_views.xml',
+        'views/stock_reorder_rfq_run_views.xml',
         'views/goal_achievement_report_views.xml',
         'views/customer_purchase_history_report_views.xml',
         'views/whatsapp_sales_trend_report_views.xml',
+        'views/whatsapp_inbound_queue_views.xml',
+        'views/whatsapp_outbox_views.xml',
+        'views/whatsapp_campaign_views.xml',
+        'views/whatsapp_message_status_views.xml',
+        'views/res_partner_auto_lead_job_views.xml',
         'data/automation_data.xml',
+        'data/whatsapp_cron_data.xml',
+        'data/report_cron_data.xml',
     ],
     'installable': True,
     'application': True,
@@ -1,8 +1,12 @@
 import logging
 import json
+import time
 from odoo import http
 from odoo.http import request, Response
 
+from ..models.whatsapp_message_seen import extract_message_ids
+from ..models.whatsapp_metrics import log_event, redact_payload, registry as metrics
+
 _logger = logging.getLogger(__name__)
 
 class WhatsAppWebhook(http.Controller):
@@ -17,11 +21,10 @@ class WhatsAppWebhook(http.Controller):
         challenge = kwargs.get('hub.challenge')
         mode = kwargs.get('hub.mode')
         
-        # TODO: Move this token to a system parameter or configuration setting
-        MY_VERIFY_TOKEN = 'LIONSCELLER_SECRET_TOKEN'
+        config = request.env['whatsapp.helper'].sudo()._get_config()
         
         if mode and verify_token:
-            if mode == 'subscribe' and verify_token == MY_VERIFY_TOKEN:
+            if mode == 'subscribe' and verify_token == config.verify_token:
                 _logger.info('WEBHOOK_VERIFIED')
                 return Response(challenge, status=200)
             else:
@@ -30,83 +33,70 @@ class WhatsAppWebhook(http.Controller):
 
     @http.route('/whatsapp/webhook', type='http', auth='public', methods=['POST'], csrf=False)
     def receive_message(self, **kwargs):
-        """Receive and process incoming WhatsApp messages."""
-        _logger.info("--------------- WHATSAPP WEBHOOK RECEIVED ---------------")
-        _logger.info(f"Headers: {dict(request.httprequest.headers)}")
-        _logger.info(f"Raw data: {request.httprequest.data}")
-        _logger.info(f"Content-Type: {request.httprequest.content_type}")
-        
-        try:
-            data = json.loads(request.httprequest.data)
-        except Exception as e:
-            _logger.error(f"FAILED TO PARSE JSON: {e}")
-            _logger.error(f"Raw data was: {request.httprequest.data}")
-            return Response("Bad Request", status=400)
-            
-        _logger.info(f"PAYLOAD: {data}")
+        """
+        Receive WhatsApp events and stage them in the inbound queue.
+        The heavy work (partners, leads, assignment) is done by the
+        queue cron, so the response time does not depend on it.
+        Only a sampled, truncated and masked summary is logged.
+        """
+        start = time.perf_counter()
+        config = request.env['whatsapp.helper'].sudo()._get_config()
 
-        try:
-            if 'entry' in data:
-                for entry in data['entry']:
-                    for change in entry.get('changes', []):
-                        value = change.get('value', {})
-                        # Log what kind of event this is
-                        if 'messages' in value:
-                            _logger.info("EVENT TYPE: MESSAGE RECEIVED")
-                            for message in value['messages']:
-                                self._process_incoming_message(message)
-                        elif 'statuses' in value:
-                            _logger.info("EVENT TYPE: STATUS UPDATE (Read/Delivered) - Ignoring")
-                        else:
-                            _logger.info(f"EVENT TYPE: OTHER ({list(value.keys())})")
-            
-            return Response('EVENT_RECEIVED', status=200)
-        except Exception as e:
-            _logger.error(f"ERROR PROCESSING WEBHOOK: {str(e)}")
-            return Response('Error', status=500)
+        with metrics.timer('parse'):
+            raw_payload = request.httprequest.get_data(as_text=True)
+            parse_error = None
+            try:
+                data = json.loads(raw_payload)
+            except ValueError as e:
+                data, parse_error = None, str(e)
 
-    def _process_incoming_message(self, message):
-        """Process a single message and create/update Odoo records."""
-        phone = message.get('from')
-        body = message.get('text', {}).get('body', '')
-        
-        if not body and message.get('type') == 'button':
-             body = message.get('button', {}).get('text', '')
+        if not isinstance(data, dict):
+            metrics.inc('whatsapp_webhook_requests_total', result='bad_request')
+            log_event(_logger, 'webhook_bad_request', level=logging.WARNING,
+                      error=parse_error or 'payload is not a JSON object',
+                      payload=redact_payload(raw_payload, config.log_payload_max))
+            return Response("Bad Request", status=400)
 
-        _logger.info(f"EXTRACTED DATA - Phone: {phone}, Body: {body}")
+        if 'entry' not in data:
+            metrics.inc('whatsapp_webhook_requests_total', result='ignored')
+            return Response('EVENT_RECEIVED', status=200)
 
-        if not phone:
-            _logger.warning("No phone number found in message")
-            return
+        # Meta redelivers on timeouts: acknowledge known messages without touching the DB
+        Seen = request.env['whatsapp.message.seen'].sudo()
+        message_ids = extract_message_ids(data)
+        if Seen._is_cached(message_ids):
+            metrics.inc('whatsapp_webhook_requests_total', result='duplicate')
+            log_event(_logger, 'webhook_duplicate', config.log_sample_rate, messages=len(message_ids))
+            return Response('EVENT_RECEIVED', status=200)
 
-        Partner = request.env['res.partner'].sudo()
-        Lead = request.env['crm.lead'].sudo()
+        try:
+            with metrics.timer('enqueue'):
+                request.env['whatsapp.inbound.queue'].sudo().enqueue_payload(raw_payload)
+                Seen._cache_after_commit(message_ids)
+        except Exception as e:
+            metrics.inc('whatsapp_webhook_requests_total', result='error')
+            _logger.exception("ERROR QUEUEING WEBHOOK: %s", e)
+            metrics.flush(request.env.registry)
+            return Response('Error', status=500)
 
-        # 1. Find or Create Partner
-        partner = Partner.search([('phone', 'ilike', phone)], limit=1)
-        if not partner:
-            partner = Partner.search([('mobile', 'ilike', phone)], limit=1)
-        
-        if not partner:
-            _logger.info(f"Creating new partner for {phone}")
-            partner = Partner.create({
-                'name': f'WhatsApp User {phone}',
-                'phone': phone,
-                'mobile': phone,
-            })
-        else:
-            _logger.info(f"Found existing partner: {partner.name}")
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        metrics.inc('whatsapp_webhook_requests_total', result='queued')
+        metrics.observe('whatsapp_webhook_duration_ms', elapsed_ms)
+        log_event(_logger, 'webhook_queued', config.log_sample_rate,
+                  messages=len(message_ids), duration_ms=round(elapsed_ms, 2),
+                  payload=redact_payload(raw_payload, config.log_payload_max))
+        metrics.flush(request.env.registry)
+        return Response('EVENT_RECEIVED', status=200)
 
-        # 2. Create Lead/Opportunity
-        source = request.env.ref('crm.source_newsletter', raise_if_not_found=False)
-        
-        lead_vals = {
-            'name': f'WhatsApp: {body[:30]}...' if body else 'New WhatsApp Message',
-            'partner_id': partner.id,
-            'description': f"Message received: {body}\nPhone: {phone}",
-            'type': 'opportunity',
-            'source_id': source.id if source else False,
-        }
-        
-        new_lead = Lead.create(lead_vals)
-        _logger.info(f"LEAD CREATED: ID {new_lead.id} - {new_lead.name}")
+    @http.route('/whatsapp/metrics', type='http', auth='user', methods=['GET'])
+    def export_metrics(self, **kwargs):
+        """
+        Counters and per-stage latency histograms of all workers (HTTP and
+        cron), in Prometheus format. Each worker adds its samples to the
+        metrics table every few seconds, so the latest ones may be missing.
+        """
+        if not request.env.user.has_group('base.group_system'):
+            return Response('Forbidden', status=403)
+        metrics.flush(request.env.registry, force=True)
+        return Response(metrics.render_prometheus(request.env.cr), status=200,
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
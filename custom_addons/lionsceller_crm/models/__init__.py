@@ -1,9 +1,23 @@
 from . import crm_lead
 from . import res_config_settings
 from . import res_partner
+from . import res_partner_auto_lead_job
+from . import res_users
+from . import crm_team_member
 from . import whatsapp_helper
+from . import whatsapp_inbound_queue
+from . import whatsapp_message_seen
+from . import whatsapp_outbox
+from . import whatsapp_campaign
+from . import whatsapp_message_status
+from . import sale_order
 from . import product_trend_report
+from . import product_sales_forecast
+from . import stock_replenishment_param
+from . import stock_safety_stock
 from . import stock_min_max_report
+from . import stock_reorder_rfq_run
+from . import stock_move
 from . import goal_achievement_report
 from . import customer_purchase_history_report
 from . import whatsapp_sales_trend_report
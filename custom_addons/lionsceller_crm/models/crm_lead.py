@@ -1,22 +1,100 @@
-from odoo import models, api, _
+from collections import namedtuple
+
+import psycopg2
+from markupsafe import Markup
+
+from odoo import models, fields, api, tools, _
 from odoo.exceptions import UserError
+from odoo.tools import SQL
+import heapq
 import random
 
+from .whatsapp_metrics import registry as metrics
+
+# Round robin sequences already known to exist, per database
+_known_sequences = set()
+
+# Bumped when users or team members change; part of the assignment cache key
+ASSIGNMENT_VERSION_SEQUENCE = 'lionsceller_crm_assignment_version'
+
+# Assignment settings and eligible salespeople, cached per registry.
+# team_user_ids maps a team id to the ids of its eligible members.
+AssignmentContext = namedtuple('AssignmentContext', ['strategy', 'user_ids', 'team_user_ids'])
+
+# Capacity and routing data of the eligible salespeople, cached per registry.
+# Territory and skill indexes map a key to the ids of the reps covering it;
+# generalist_ids are the reps without a territory.
+CapacityIndex = namedtuple('CapacityIndex', [
+    'weights', 'max_open', 'by_country', 'by_city', 'by_skill', 'generalist_ids',
+])
+
 
 class CrmLead(models.Model):
     _inherit = 'crm.lead'
 
+    whatsapp_last_message_at = fields.Datetime(
+        string='Último Mensaje de WhatsApp', readonly=True, copy=False,
+        help='Fecha del último mensaje recibido por WhatsApp en esta oportunidad')
+    product_categ_id = fields.Many2one(
+        'product.category', string='Categoría de Producto',
+        help='Línea de producto de interés; la asignación por capacidad la envía a asesores con esa especialidad')
+
+    def init(self):
+        super().init()
+        self.env.cr.execute(SQL("CREATE SEQUENCE IF NOT EXISTS %s", SQL.identifier(ASSIGNMENT_VERSION_SEQUENCE)))
+        # Until the first nextval() last_value does not move: consume it now
+        self.env.cr.execute("SELECT nextval(%s)", [ASSIGNMENT_VERSION_SEQUENCE])
+        # Open opportunity lookup per partner for WhatsApp conversation threading
+        tools.create_index(
+            self.env.cr, 'crm_lead_whatsapp_open_partner_idx', self._table,
+            ['partner_id', 'id DESC'],
+            where="active AND type = 'opportunity' AND partner_id IS NOT NULL",
+        )
+
     @api.model_create_multi
     def create(self, vals_list):
         """
         Override create to auto-assign salesperson if missing.
         """
         leads = super(CrmLead, self).create(vals_list)
-        for lead in leads:
-            if not lead.user_id:
-                lead._auto_assign_salesperson()
+        with metrics.timer('auto_assign'):
+            leads.filtered(lambda lead: not lead.user_id)._auto_assign_salesperson()
+        metrics.flush(self.env.registry)
         return leads
     
+    @api.model
+    def _find_open_whatsapp_leads(self, partner_ids, since):
+        """
+        Latest open opportunity of each partner with activity after `since`.
+        Served by crm_lead_whatsapp_open_partner_idx in a single query.
+        :return: dict {partner_id: crm.lead}
+        """
+        if not partner_ids:
+            return {}
+        self.flush_model(['partner_id', 'active', 'type', 'probability', 'whatsapp_last_message_at'])
+        self.env.cr.execute("""
+            SELECT DISTINCT ON (partner_id) partner_id, id
+            FROM crm_lead
+            WHERE partner_id = ANY(%s)
+              AND active
+              AND type = 'opportunity'
+              AND partner_id IS NOT NULL
+              AND COALESCE(probability, 0) < 100
+              AND COALESCE(whatsapp_last_message_at, create_date) >= %s
+            ORDER BY partner_id, id DESC
+        """, [list(partner_ids), since])
+        return {partner_id: self.browse(lead_id) for partner_id, lead_id in self.env.cr.fetchall()}
+
+    def _post_whatsapp_inbound(self, body, partner):
+        """Append an inbound WhatsApp message to the opportunity chatter."""
+        self.ensure_one()
+        self.message_post(
+            body=Markup("📱 <b>WhatsApp:</b> %s") % (body or _('(mensaje sin texto)')),
+            author_id=partner.id,
+            message_type='comment',
+            subtype_xmlid='mail.mt_note',
+        )
+
     def action_send_whatsapp(self):
         """Abre un wizard para enviar mensaje de WhatsApp"""
         self.ensure_one()
@@ -74,90 +152,311 @@ class CrmLead(models.Model):
 
     def _auto_assign_salesperson(self):
         """
-        Assign a salesperson based on configured strategy.
-        Strategies: round_robin, random, load_based
+        Assign a salesperson to every lead in self based on configured strategy.
+        Strategies: round_robin, random, load_based, capacity
+        Each strategy is a `_assign_<strategy>` method, so new engines can be
+        plugged in by extending the selection and adding the method.
+        """
+        if not self:
+            return
+        strategy = self._get_assignment_context().strategy
+        
+        engine = getattr(self, '_assign_%s' % strategy, None)
+        if engine is None:
+            engine = self._assign_round_robin  # Default fallback
+        engine()
+
+    @api.model
+    def _get_assignment_version(self):
+        """
+        Cache key of the assignment context, or None when this transaction
+        changed salespeople or teams and must not use the cached values.
+        """
+        if self.env.cr.postcommit.data.get(ASSIGNMENT_VERSION_SEQUENCE):
+            return None
+        self.env.cr.execute(SQL("SELECT last_value FROM %s", SQL.identifier(ASSIGNMENT_VERSION_SEQUENCE)))
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def _invalidate_assignment_context(self):
+        """
+        Discard the cached assignment context in every worker, without
+        clearing the other registry caches. The version moves after commit,
+        on a fresh cursor, so no worker caches data older than the new key.
         """
+        postcommit = self.env.cr.postcommit
+        if postcommit.data.get(ASSIGNMENT_VERSION_SEQUENCE):
+            return  # Already scheduled in this transaction
+        postcommit.data[ASSIGNMENT_VERSION_SEQUENCE] = True
+        registry = self.env.registry
+
+        @postcommit.add
+        def bump_version():
+            with registry.cursor() as cr:
+                cr.execute("SELECT nextval(%s)", [ASSIGNMENT_VERSION_SEQUENCE])
+
+    @api.model
+    def _get_assignment_context(self):
+        """
+        Strategy, eligible salespeople and team membership used by the
+        auto-assignment. Eligible users are the active members of the sales
+        group that are not out of office, sorted by id.
+        Cached per assignment version; settings changes clear the registry cache.
+        """
+        version = self._get_assignment_version()
+        if version is None:
+            return self._compute_assignment_context()
+        return self._get_cached_assignment_context(version)
+
+    @api.model
+    @tools.ormcache('version')
+    def _get_cached_assignment_context(self, version):
+        return self._compute_assignment_context()
+
+    @api.model
+    def _compute_assignment_context(self):
         strategy = self.env['ir.config_parameter'].sudo().get_param(
             'lionsceller_crm.lead_assignment_strategy', 'round_robin'
         )
+        sales_group = self.env.ref('sales_team.group_sale_salesman', raise_if_not_found=False)
+        users = self.env['res.users']
+        if sales_group:
+            users = sales_group.sudo().users.filtered(
+                lambda u: u.active and not u.share and not u.lead_assignment_paused)
+        user_ids = tuple(sorted(users.ids))
         
-        if strategy == 'round_robin':
-            user = self._get_next_salesperson_round_robin()
-        elif strategy == 'random':
-            user = self._get_random_salesperson()
-        elif strategy == 'load_based':
-            user = self._get_least_loaded_salesperson()
-        else:
-            user = self._get_next_salesperson_round_robin()  # Default fallback
-        
-        if user:
-            self.user_id = user.id
+        team_user_ids = {}
+        if user_ids:
+            groups = self.env['crm.team.member'].sudo()._read_group(
+                [('user_id', 'in', user_ids)],
+                ['crm_team_id'],
+                ['user_id:array_agg'],
+            )
+            team_user_ids = {team.id: tuple(sorted(member_ids)) for team, member_ids in groups}
+        return AssignmentContext(strategy, user_ids, team_user_ids)
 
     def _get_sales_team_users(self):
         """
-        Get all active users in the sales team group.
+        Get all salespeople eligible for auto-assignment.
         """
-        sales_group = self.env.ref('sales_team.group_sale_salesman', raise_if_not_found=False)
-        if sales_group:
-            # Filter only active users
-            return sales_group.users.filtered(lambda u: u.active)
-        return self.env['res.users']
+        return self.env['res.users'].browse(self._get_assignment_context().user_ids)
 
-    def _get_next_salesperson_round_robin(self):
+    def _get_round_robin_users(self, team):
         """
-        Round Robin: Assign leads in rotation among all salespeople.
-        Uses a counter stored in ir.config_parameter to track the last assigned user.
+        Rotation of a team: its eligible members, or all eligible salespeople
+        when the team has none. Sorted by id so the rotation is stable.
         """
-        users = self._get_sales_team_users()
-        if not users:
-            return None
+        context = self._get_assignment_context()
+        user_ids = context.team_user_ids.get(team.id) or context.user_ids
+        return self.env['res.users'].browse(user_ids)
+
+    def _assign_round_robin(self):
+        """
+        Round Robin: Assign leads in rotation among the salespeople of their team.
+        Slots come from one PostgreSQL sequence per team, reserved for the whole
+        batch in a single query, so concurrent transactions never wait on a
+        shared counter row.
+        """
+        leads_by_user = {}
+        for team, team_leads in self.grouped('team_id').items():
+            users = self._get_round_robin_users(team)
+            if not users:
+                continue
+            slots = self._reserve_round_robin_slots(team.id, len(team_leads))
+            for lead, slot in zip(team_leads, slots):
+                user = users[slot % len(users)]
+                leads_by_user[user] = leads_by_user.get(user, self.browse()) | lead
         
-        # Get the last assigned user index
-        last_index = int(self.env['ir.config_parameter'].sudo().get_param(
-            'lionsceller_crm.last_assigned_index', '-1'
-        ))
+        for user, leads in leads_by_user.items():
+            leads.write({'user_id': user.id})
+
+    @api.model
+    def _reserve_round_robin_slots(self, team_id, count):
+        """
+        Reserve `count` round robin positions for a team (0 = no team).
+        nextval() is not transactional: it neither locks nor rolls back.
+        """
+        seq_name = 'lionsceller_crm_round_robin_team_%d' % (team_id or 0)
+        key = (self.env.cr.dbname, seq_name)
+        if key not in _known_sequences:
+            self.env.cr.execute("SELECT to_regclass(%s)", [seq_name])
+            if self.env.cr.fetchone()[0]:
+                _known_sequences.add(key)
+            else:
+                try:
+                    with self.env.cr.savepoint(flush=False):
+                        self.env.cr.execute(SQL(
+                            "CREATE SEQUENCE IF NOT EXISTS %s MINVALUE 0 START 0", SQL.identifier(seq_name)))
+                except psycopg2.Error:
+                    pass  # created meanwhile by a concurrent transaction
+                self.env.cr.postcommit.add(lambda: _known_sequences.add(key))
         
-        # Calculate next index (circular)
-        next_index = (last_index + 1) % len(users)
+        self.env.cr.execute("SELECT nextval(%s) FROM generate_series(1, %s)", [seq_name, count])
+        return [row[0] for row in self.env.cr.fetchall()]
+
+    def _assign_random(self):
+        """
+        Random: Assign each lead to a random salesperson.
+        """
+        user_ids = self._get_assignment_context().user_ids
+        if not user_ids:
+            return
         
-        # Update the counter
-        self.env['ir.config_parameter'].sudo().set_param(
-            'lionsceller_crm.last_assigned_index', str(next_index)
-        )
+        lead_ids_by_user = {}
+        for lead in self:
+            lead_ids_by_user.setdefault(random.choice(user_ids), []).append(lead.id)
         
-        return users[next_index]
+        for user_id, lead_ids in lead_ids_by_user.items():
+            self.browse(lead_ids).write({'user_id': user_id})
 
-    def _get_random_salesperson(self):
+    def _get_salesperson_loads(self, users):
         """
-        Random: Assign a random salesperson from the sales team.
+        Active leads of each salesperson (not in 'Won' or 'Lost' stages),
+        counted in a single grouped query.
+        :return: dict {user_id: lead_count}, with 0 for users without leads
         """
-        users = self._get_sales_team_users()
+        loads = dict.fromkeys(users.ids, 0)
         if not users:
-            return None
-        
-        return random.choice(users)
+            return loads
+        groups = self.env['crm.lead']._read_group(
+            [
+                ('user_id', 'in', users.ids),
+                ('active', '=', True),
+                ('probability', '<', 100),  # Not won
+                ('probability', '>', 0),    # Not lost
+            ],
+            ['user_id'],
+            ['__count'],
+        )
+        for user, lead_count in groups:
+            loads[user.id] = lead_count
+        return loads
 
-    def _get_least_loaded_salesperson(self):
+    def _assign_load_based(self):
         """
-        Load-Based: Assign to the salesperson with the fewest active leads.
-        Active leads are those not in 'Won' or 'Lost' stages.
+        Load-Based: Assign every lead to the salesperson with the fewest active
+        leads. Loads are read once and kept in a heap that is updated as the
+        batch is distributed.
         """
         users = self._get_sales_team_users()
         if not users:
-            return None
+            return
+        
+        loads = self._get_salesperson_loads(users)
+        heap = [(load, user_id) for user_id, load in loads.items()]
+        heapq.heapify(heap)
         
-        # Count active leads for each user
-        user_loads = []
+        lead_ids_by_user = {}
+        for lead in self:
+            load, user_id = heap[0]
+            heapq.heapreplace(heap, (load + 1, user_id))
+            lead_ids_by_user.setdefault(user_id, []).append(lead.id)
+        
+        for user_id, lead_ids in lead_ids_by_user.items():
+            self.browse(lead_ids).write({'user_id': user_id})
+
+    @api.model
+    def _get_capacity_index(self):
+        """
+        Weights, open lead limits and territory/skill indexes of the eligible
+        salespeople. Cached with the assignment context.
+        """
+        version = self._get_assignment_version()
+        if version is None:
+            return self._compute_capacity_index()
+        return self._get_cached_capacity_index(version)
+
+    @api.model
+    @tools.ormcache('version')
+    def _get_cached_capacity_index(self, version):
+        return self._compute_capacity_index()
+
+    @api.model
+    def _compute_capacity_index(self):
+        users = self.env['res.users'].sudo().browse(self._get_assignment_context().user_ids)
+        weights, max_open = {}, {}
+        by_country, by_city, by_skill = {}, {}, {}
+        generalist_ids = []
         for user in users:
-            lead_count = self.env['crm.lead'].search_count([
-                ('user_id', '=', user.id),
-                ('active', '=', True),
-                ('probability', '<', 100),  # Not won
-                ('probability', '>', 0)      # Not lost
-            ])
-            user_loads.append((user, lead_count))
+            if user.lead_capacity_weight <= 0:
+                continue
+            weights[user.id] = user.lead_capacity_weight
+            max_open[user.id] = user.lead_max_open
+            cities = [city.strip().lower() for city in (user.lead_city_names or '').split(',') if city.strip()]
+            for city in cities:
+                by_city.setdefault(city, []).append(user.id)
+            for country in user.lead_country_ids:
+                by_country.setdefault(country.id, []).append(user.id)
+            for categ in user.lead_skill_categ_ids:
+                by_skill.setdefault(categ.id, []).append(user.id)
+            if not cities and not user.lead_country_ids:
+                generalist_ids.append(user.id)
+        
+        def freeze(index):
+            return {key: frozenset(user_ids) for key, user_ids in index.items()}
         
-        # Sort by load (ascending) and return the user with minimum load
-        user_loads.sort(key=lambda x: x[1])
-        return user_loads[0][0] if user_loads else None
+        return CapacityIndex(weights, max_open, freeze(by_country), freeze(by_city),
+                             freeze(by_skill), frozenset(generalist_ids))
 
+    def _get_capacity_candidates(self, index, team_id, city, country_id, categ_ids):
+        """
+        Reps that may receive a lead: the territory (city, then country, then
+        generalists), narrowed to the lead's team and product skill whenever
+        that leaves someone.
+        """
+        candidates = (
+            index.by_city.get(city)
+            or index.by_country.get(country_id)
+            or index.generalist_ids
+            or frozenset(index.weights)
+        )
+        team_ids = self._get_assignment_context().team_user_ids.get(team_id)
+        if team_ids:
+            candidates = candidates.intersection(team_ids) or candidates
+        skilled = frozenset().union(*(index.by_skill.get(categ_id, ()) for categ_id in categ_ids))
+        if skilled:
+            candidates = candidates.intersection(skilled) or candidates
+        return sorted(candidates)
+
+    def _assign_capacity(self):
+        """
+        Capacity: Route each lead to the reps of its territory and product skill
+        and pick the one with the lowest weighted load, (load + 1) / weight,
+        skipping reps at their maximum of open leads. Leads without a rep
+        under capacity stay unassigned.
+        """
+        index = self._get_capacity_index()
+        if not index.weights:
+            return
+        
+        loads = self._get_salesperson_loads(self.env['res.users'].browse(list(index.weights)))
+        candidates_cache = {}
+        lead_ids_by_user = {}
+        for lead in self:
+            categ = lead.product_categ_id
+            key = (
+                lead.team_id.id,
+                (lead.city or lead.partner_id.city or '').strip().lower(),
+                (lead.country_id or lead.partner_id.country_id).id,
+                categ.id,
+            )
+            candidates = candidates_cache.get(key)
+            if candidates is None:
+                categ_ids = [int(categ_id) for categ_id in categ.parent_path.split('/') if categ_id] if categ else []
+                candidates = candidates_cache[key] = self._get_capacity_candidates(index, key[0], key[1], key[2], categ_ids)
+            
+            best_id, best_score = None, None
+            for user_id in candidates:
+                load = loads[user_id]
+                if index.max_open[user_id] and load >= index.max_open[user_id]:
+                    continue
+                score = (load + 1) / index.weights[user_id]
+                if best_score is None or score < best_score:
+                    best_id, best_score = user_id, score
+            if best_id is None:
+                continue
+            loads[best_id] += 1
+            lead_ids_by_user.setdefault(best_id, []).append(lead.id)
+        
+        for user_id, lead_ids in lead_ids_by_user.items():
+            self.browse(lead_ids).write({'user_id': user_id})
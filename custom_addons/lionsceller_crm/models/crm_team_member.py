@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from odoo import api, models
+
+# Campos de la membresía que forman parte del contexto de asignación cacheado
+ASSIGNMENT_MEMBER_FIELDS = {'user_id', 'crm_team_id', 'active'}
+
+
+class CrmTeamMember(models.Model):
+    _inherit = 'crm.team.member'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        members = super().create(vals_list)
+        self.env['crm.lead']._invalidate_assignment_context()
+        return members
+
+    def write(self, vals):
+        res = super().write(vals)
+        if ASSIGNMENT_MEMBER_FIELDS.intersection(vals):
+            self.env['crm.lead']._invalidate_assignment_context()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env['crm.lead']._invalidate_assignment_context()
+        return res
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import logging
+from datetime import date
+
+import numpy as np
+from dateutil.relativedelta import relativedelta
+
+from odoo import api, fields, models
+from odoo.tools import SQL
+
+from .product_trend_report import FACT_TABLE
+from .sales_forecaster import confidence_level, fit_holt, holt_horizon
+
+_logger = logging.getLogger(__name__)
+
+# Meses de historia usados para ajustar el modelo
+HISTORY_MONTHS = 24
+# Horizonte guardado en forecast_qty/lower_qty/upper_qty
+DEFAULT_HORIZON = 3
+
+
+class ProductSalesForecast(models.Model):
+    """Pronóstico de ventas por producto y compañía
+
+    Una fila por producto con los parámetros de Holt ajustados a su demanda
+    mensual y el pronóstico a DEFAULT_HORIZON meses con intervalo de
+    confianza del 95%. Se recalcula completo por un cron desde la tabla de
+    hechos de tendencias; los reportes pueden unirse a esta tabla.
+    """
+    _name = 'product.sales.forecast'
+    _description = 'Pronóstico de Ventas por Producto'
+    _log_access = False
+    _order = 'forecast_qty desc'
+    _rec_name = 'product_id'
+
+    product_id = fields.Many2one('product.product', string='Producto', required=True,
+                                 ondelete='cascade', readonly=True)
+    company_id = fields.Many2one('res.company', string='Compañía', required=True,
+                                 ondelete='cascade', readonly=True)
+    months_ahead = fields.Integer(string='Meses Pronosticados', readonly=True)
+    forecast_qty = fields.Float(string='Pronóstico', digits=(16, 2), readonly=True)
+    lower_qty = fields.Float(string='Límite Inferior (95%)', digits=(16, 2), readonly=True)
+    upper_qty = fields.Float(string='Límite Superior (95%)', digits=(16, 2), readonly=True)
+    monthly_forecast = fields.Float(string='Pronóstico Próximo Mes', digits=(16, 2), readonly=True)
+    avg_monthly = fields.Float(string='Promedio Mensual', digits=(16, 2), readonly=True)
+    history_months = fields.Integer(string='Meses de Historia', readonly=True)
+    confidence = fields.Selection([
+        ('high', 'Alta'),
+        ('medium', 'Media'),
+        ('low', 'Baja'),
+    ], string='Confianza', readonly=True)
+    level = fields.Float(string='Nivel', readonly=True)
+    trend = fields.Float(string='Tendencia', readonly=True)
+    sigma = fields.Float(string='Error Estándar', readonly=True)
+    alpha = fields.Float(string='Alpha', readonly=True)
+    beta = fields.Float(string='Beta', readonly=True)
+    computed_at = fields.Datetime(string='Calculado el', readonly=True)
+
+    _sql_constraints = [
+        ('product_company_unique', 'UNIQUE(product_id, company_id)',
+         'Solo puede existir un pronóstico por producto y compañía.'),
+    ]
+
+    @api.model
+    def _cron_compute_forecasts(self, months_ahead=DEFAULT_HORIZON):
+        """
+        Recalcula el pronóstico de todo el catálogo
+
+        Lee la demanda mensual de todos los productos en una sola consulta,
+        ajusta Holt vectorizado con NumPy y reescribe la tabla con un solo
+        INSERT.
+        """
+        month_end = date.today().replace(day=1)  # Solo meses completos
+        month_start = month_end - relativedelta(months=HISTORY_MONTHS)
+        self.env.cr.execute(SQL("""
+            SELECT product_id, company_id,
+                   (EXTRACT(YEAR FROM order_date) * 12 + EXTRACT(MONTH FROM order_date))::int AS month,
+                   SUM(qty_sold) AS qty
+            FROM %s
+            WHERE order_date >= %s AND order_date < %s
+              AND company_id IS NOT NULL
+            GROUP BY 1, 2, 3
+        """, SQL.identifier(FACT_TABLE), month_start, month_end))
+        rows = self.env.cr.fetchall()
+
+        self.env.cr.execute(SQL("DELETE FROM %s", SQL.identifier(self._table)))
+        if not rows:
+            return
+
+        keys = sorted({(product_id, company_id) for product_id, company_id, __, __ in rows})
+        key_index = {key: i for i, key in enumerate(keys)}
+        first_month = month_start.year * 12 + month_start.month
+        demand = np.zeros((len(keys), HISTORY_MONTHS))
+        for product_id, company_id, month, qty in rows:
+            demand[key_index[product_id, company_id], month - first_month] = float(qty or 0.0)
+        start = np.argmax(demand > 0, axis=1)
+
+        fit = fit_holt(demand, start)
+        forecast, lower, upper = holt_horizon(
+            fit['level'], fit['trend'], fit['sigma'], fit['alpha'], fit['beta'], months_ahead)
+        monthly = np.maximum(fit['level'] + fit['trend'], 0.0)
+        history = fit['history']
+        avg_monthly = demand.sum(axis=1) / np.maximum(history, 1)
+        confidence = [
+            confidence_level(sigma, level, months)
+            for sigma, level, months in zip(fit['sigma'], fit['level'], history)
+        ]
+
+        self.env.cr.execute(SQL("""
+            INSERT INTO %s (
+                product_id, company_id, months_ahead, forecast_qty, lower_qty, upper_qty,
+                monthly_forecast, avg_monthly, history_months, confidence,
+                level, trend, sigma, alpha, beta, computed_at
+            )
+            SELECT v.product_id, v.company_id, %s, v.forecast_qty, v.lower_qty, v.upper_qty,
+                   v.monthly_forecast, v.avg_monthly, v.history_months, v.confidence,
+                   v.level, v.trend, v.sigma, v.alpha, v.beta, NOW() AT TIME ZONE 'UTC'
+            FROM (
+                SELECT UNNEST(%s::int[]) AS product_id,
+                       UNNEST(%s::int[]) AS company_id,
+                       UNNEST(%s::float[]) AS forecast_qty,
+                       UNNEST(%s::float[]) AS lower_qty,
+                       UNNEST(%s::float[]) AS upper_qty,
+                       UNNEST(%s::float[]) AS monthly_forecast,
+                       UNNEST(%s::float[]) AS avg_monthly,
+                       UNNEST(%s::int[]) AS history_months,
+                       UNNEST(%s::varchar[]) AS confidence,
+                       UNNEST(%s::float[]) AS level,
+                       UNNEST(%s::float[]) AS trend,
+                       UNNEST(%s::float[]) AS sigma,
+                       UNNEST(%s::float[]) AS alpha,
+                       UNNEST(%s::float[]) AS beta
+            ) v
+            WHERE v.product_id IN (SELECT id FROM product_product)
+        """,
+            SQL.identifier(self._table),
+            months_ahead,
+            [key[0] for key in keys],
+            [key[1] for key in keys],
+            forecast.tolist(),
+            lower.tolist(),
+            upper.tolist(),
+            monthly.tolist(),
+            avg_monthly.tolist(),
+            history.tolist(),
+            confidence,
+            fit['level'].tolist(),
+            fit['trend'].tolist(),
+            fit['sigma'].tolist(),
+            fit['alpha'].tolist(),
+            fit['beta'].tolist(),
+        ))
+        self.invalidate_model()
+        _logger.info("Pronóstico de ventas: %s productos calculados", len(keys))
+
+    @api.model
+    def _get_forecast(self, product_id, months_ahead=DEFAULT_HORIZON):
+        """
+        Pronóstico guardado de un producto en la compañía actual, extendido
+        al horizonte pedido con sus parámetros de Holt
+        """
+        forecast = self.search([
+            ('product_id', '=', product_id),
+            ('company_id', '=', self.env.company.id),
+        ], limit=1)
+        if not forecast:
+            return {
+                'forecast_qty': 0.0,
+                'lower_qty': 0.0,
+                'upper_qty': 0.0,
+                'avg_monthly': 0.0,
+                'confidence': 'low',
+                'months_ahead': months_ahead,
+            }
+
+        if months_ahead == forecast.months_ahead:
+            total, lower, upper = forecast.forecast_qty, forecast.lower_qty, forecast.upper_qty
+        else:
+            total, lower, upper = holt_horizon(
+                forecast.level, forecast.trend, forecast.sigma, forecast.alpha, forecast.beta, months_ahead)
+        return {
+            'forecast_qty': round(float(total), 2),
+            'lower_qty': round(float(lower), 2),
+            'upper_qty': round(float(upper), 2),
+            'avg_monthly': round(forecast.avg_monthly, 2),
+            'confidence': forecast.confidence,
+            'months_ahead': months_ahead,
+        }
@@ -1,7 +1,27 @@
 # -*- coding: utf-8 -*-
-from odoo import models, fields, api, tools
+import logging
 from datetime import datetime, timedelta
 
+from odoo import models, fields, api, tools
+from odoo.tools import SQL
+
+from .report_cache import TTLCache
+
+_logger = logging.getLogger(__name__)
+
+# Hechos diarios materializados y días pendientes de recalcular
+FACT_TABLE = 'product_trend_report_fact'
+DIRTY_TABLE = 'product_trend_report_dirty'
+# Demanda diaria por producto (para inventarios mín/máx)
+DEMAND_TABLE = 'product_demand_daily'
+# Versión de la tabla de hechos: aumenta con cada recálculo, en la misma transacción
+VERSION_TABLE = 'product_trend_report_version'
+
+# Segundos que se reutiliza un resultado de get_top_trending_products
+TOP_TRENDING_TTL = 300
+
+top_trending_cache = TTLCache(ttl=TOP_TRENDING_TTL)
+
 
 class ProductTrendReport(models.Model):
     """Reporte de Tendencias de Productos - Análisis de Ventas"""
@@ -31,162 +51,278 @@ class ProductTrendReport(models.Model):
     partner_id = fields.Many2one('res.partner', string='Cliente', readonly=True)
     user_id = fields.Many2one('res.users', string='Vendedor', readonly=True)
     team_id = fields.Many2one('crm.team', string='Equipo de Ventas', readonly=True)
+    company_id = fields.Many2one('res.company', string='Compañía', readonly=True)
     
-    # Indicadores de Tendencia (calculados)
-    trend_percentage = fields.Float(string='% Tendencia', compute='_compute_trend', store=False)
+    # Indicadores de Tendencia (calculados en la vista contra el promedio de 90 días del producto)
+    trend_percentage = fields.Float(string='% Tendencia', readonly=True, digits=(16, 2), aggregator='avg')
     trend_status = fields.Selection([
         ('hot', '🔥 Tendencia Alta'),
         ('rising', '📈 En Crecimiento'),
         ('stable', '➡️ Estable'),
         ('declining', '📉 En Declive'),
         ('cold', '❄️ Baja Demanda'),
-    ], string='Estado de Tendencia', compute='_compute_trend', store=False)
-
-    @api.depends('qty_sold', 'total_revenue')
-    def _compute_trend(self):
-        """Calcula el estado de tendencia basado en ventas recientes"""
-        for record in self:
-            # Comparar con promedio general del producto
-            avg_sales = self.search([
-                ('product_id', '=', record.product_id.id),
-                ('order_date', '>=', fields.Date.today() - timedelta(days=90))
-            ])
-            
-            if avg_sales:
-                avg_qty = sum(avg_sales.mapped('qty_sold')) / len(avg_sales)
-                if avg_qty > 0:
-                    record.trend_percentage = ((record.qty_sold - avg_qty) / avg_qty) * 100
-                    
-                    # Clasificar tendencia
-                    if record.trend_percentage >= 50:
-                        record.trend_status = 'hot'
-                    elif record.trend_percentage >= 20:
-                        record.trend_status = 'rising'
-                    elif record.trend_percentage >= -10:
-                        record.trend_status = 'stable'
-                    elif record.trend_percentage >= -30:
-                        record.trend_status = 'declining'
-                    else:
-                        record.trend_status = 'cold'
-                else:
-                    record.trend_percentage = 0.0
-                    record.trend_status = 'stable'
-            else:
-                record.trend_percentage = 0.0
-                record.trend_status = 'stable'
+    ], string='Estado de Tendencia', readonly=True)
 
     def init(self):
-        """Inicializa la vista SQL del reporte"""
-        tools.drop_view_if_exists(self.env.cr, self._table)
+        """
+        Inicializa la tabla de hechos diarios y la vista SQL del reporte
+
+        La agregación por producto/día/cliente/vendedor se guarda en
+        product_trend_report_fact; la vista solo le agrega la tendencia.
+        La primera vez se llena completa y después solo se recalculan los
+        días que tocan las órdenes confirmadas o modificadas.
+        """
+        cr = self.env.cr
+        tools.drop_view_if_exists(cr, self._table)
         
-        # Query SQL simplificada - PostgreSQL requiere todas las columnas en GROUP BY
-        query = """
+        cr.execute(SQL("""
+            CREATE TABLE IF NOT EXISTS %s (
+                id integer PRIMARY KEY,
+                product_id integer,
+                product_tmpl_id integer,
+                categ_id integer,
+                order_date date,
+                year varchar,
+                month varchar,
+                quarter varchar,
+                qty_sold numeric,
+                total_revenue numeric,
+                avg_price numeric,
+                order_count integer,
+                partner_id integer,
+                user_id integer,
+                team_id integer,
+                company_id integer
+            )
+        """, SQL.identifier(FACT_TABLE)))
+        cr.execute(SQL("CREATE TABLE IF NOT EXISTS %s (day date PRIMARY KEY)", SQL.identifier(DIRTY_TABLE)))
+        cr.execute(SQL("""
+            CREATE TABLE IF NOT EXISTS %s (
+                product_id integer NOT NULL,
+                day date NOT NULL,
+                qty numeric NOT NULL,
+                PRIMARY KEY (product_id, day)
+            )
+        """, SQL.identifier(DEMAND_TABLE)))
+        cr.execute(SQL("CREATE TABLE IF NOT EXISTS %s (version integer NOT NULL)", SQL.identifier(VERSION_TABLE)))
+        cr.execute(SQL("""
+            INSERT INTO %s (version)
+            SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM %s)
+        """, SQL.identifier(VERSION_TABLE), SQL.identifier(VERSION_TABLE)))
+        tools.create_index(cr, 'product_trend_report_fact_product_date_idx', FACT_TABLE, ['product_id', 'order_date'])
+        tools.create_index(cr, 'product_trend_report_fact_categ_month_idx', FACT_TABLE, ['categ_id', 'month'])
+        tools.create_index(cr, 'product_trend_report_fact_user_month_idx', FACT_TABLE, ['user_id', 'month'])
+        tools.create_index(cr, 'product_trend_report_fact_date_idx', FACT_TABLE, ['order_date', 'company_id'])
+        tools.create_index(cr, 'product_demand_daily_day_idx', DEMAND_TABLE, ['day'])
+        
+        cr.execute(SQL("""
+            SELECT EXISTS (SELECT 1 FROM %s), EXISTS (SELECT 1 FROM %s)
+        """, SQL.identifier(FACT_TABLE), SQL.identifier(DEMAND_TABLE)))
+        if not all(cr.fetchone()):
+            self._refresh_facts()
+        
+        # La tendencia compara cada fila con el promedio del producto en los últimos
+        # 90 días, calculado una sola vez por producto
+        cr.execute(SQL("""
             CREATE OR REPLACE VIEW %s AS (
+                WITH recent AS (
+                    SELECT product_id, AVG(qty_sold) AS avg_qty
+                    FROM %s
+                    WHERE order_date >= CURRENT_DATE - 90
+                    GROUP BY product_id
+                ),
+                scored AS (
+                    SELECT 
+                        f.*,
+                        CASE WHEN r.avg_qty > 0
+                             THEN (f.qty_sold - r.avg_qty) / r.avg_qty * 100
+                             ELSE 0 END AS trend_percentage
+                    FROM %s f
+                    LEFT JOIN recent r ON r.product_id = f.product_id
+                )
                 SELECT 
-                    MIN(sol.id) AS id,
-                    sol.product_id,
-                    MIN(pt.id) AS product_tmpl_id,
-                    MIN(pt.categ_id) AS categ_id,
-                    DATE(so.date_order) AS order_date,
-                    TO_CHAR(so.date_order, 'YYYY') AS year,
-                    TO_CHAR(so.date_order, 'YYYY-MM') AS month,
-                    'Q' || TO_CHAR(so.date_order, 'Q') || ' ' || TO_CHAR(so.date_order, 'YYYY') AS quarter,
-                    SUM(sol.product_uom_qty) AS qty_sold,
-                    SUM(sol.price_subtotal) AS total_revenue,
-                    AVG(sol.price_unit) AS avg_price,
-                    COUNT(DISTINCT so.id) AS order_count,
-                    so.partner_id,
-                    so.user_id,
-                    so.team_id
-                FROM 
-                    sale_order_line sol
-                    INNER JOIN sale_order so ON sol.order_id = so.id
-                    INNER JOIN product_product pp ON sol.product_id = pp.id
-                    INNER JOIN product_template pt ON pp.product_tmpl_id = pt.id
-                WHERE 
-                    so.state IN ('sale', 'done')
-                GROUP BY 
-                    sol.product_id,
-                    DATE(so.date_order),
-                    TO_CHAR(so.date_order, 'YYYY'),
-                    TO_CHAR(so.date_order, 'YYYY-MM'),
-                    TO_CHAR(so.date_order, 'Q'),
-                    TO_CHAR(so.date_order, 'YYYY'),
-                    so.partner_id,
-                    so.user_id,
-                    so.team_id
+                    s.*,
+                    CASE
+                        WHEN s.trend_percentage >= 50 THEN 'hot'
+                        WHEN s.trend_percentage >= 20 THEN 'rising'
+                        WHEN s.trend_percentage >= -10 THEN 'stable'
+                        WHEN s.trend_percentage >= -30 THEN 'declining'
+                        ELSE 'cold'
+                    END AS trend_status
+                FROM scored s
             )
-        """ % self._table
+        """, SQL.identifier(self._table), SQL.identifier(FACT_TABLE), SQL.identifier(FACT_TABLE)))
+
+    @api.model
+    def _refresh_facts(self, days=None):
+        """
+        Recalcula los hechos y la demanda diaria de los días indicados, o de
+        todo el historial
+
+        :param days: lista de fechas (date) a recalcular; None para todo
+        """
+        cr = self.env.cr
+        self.env['sale.order.line'].flush_model()
+        self.env['sale.order'].flush_model()
+        if days is None:
+            cr.execute(SQL("TRUNCATE %s, %s", SQL.identifier(FACT_TABLE), SQL.identifier(DEMAND_TABLE)))
+            day_join = SQL()
+            day_filter = SQL()
+        else:
+            cr.execute(SQL("DELETE FROM %s WHERE order_date = ANY(%s::date[])", SQL.identifier(FACT_TABLE), days))
+            cr.execute(SQL("DELETE FROM %s WHERE day = ANY(%s::date[])", SQL.identifier(DEMAND_TABLE), days))
+            day_filter = SQL("WHERE order_date = ANY(%s::date[])", days)
+            # Rango sobre date_order para aprovechar su índice
+            day_join = SQL(
+                "INNER JOIN unnest(%s::date[]) AS d(day) ON so.date_order >= d.day AND so.date_order < d.day + 1",
+                days)
         
-        self.env.cr.execute(query)
+        # PostgreSQL requiere todas las columnas en GROUP BY
+        cr.execute(SQL("""
+            INSERT INTO %s (
+                id, product_id, product_tmpl_id, categ_id, order_date, year, month, quarter,
+                qty_sold, total_revenue, avg_price, order_count, partner_id, user_id, team_id, company_id
+            )
+            SELECT 
+                MIN(sol.id) AS id,
+                sol.product_id,
+                MIN(pt.id) AS product_tmpl_id,
+                MIN(pt.categ_id) AS categ_id,
+                DATE(so.date_order) AS order_date,
+                TO_CHAR(so.date_order, 'YYYY') AS year,
+                TO_CHAR(so.date_order, 'YYYY-MM') AS month,
+                'Q' || TO_CHAR(so.date_order, 'Q') || ' ' || TO_CHAR(so.date_order, 'YYYY') AS quarter,
+                SUM(sol.product_uom_qty) AS qty_sold,
+                SUM(sol.price_subtotal) AS total_revenue,
+                AVG(sol.price_unit) AS avg_price,
+                COUNT(DISTINCT so.id) AS order_count,
+                so.partner_id,
+                so.user_id,
+                so.team_id,
+                so.company_id
+            FROM 
+                sale_order_line sol
+                INNER JOIN sale_order so ON sol.order_id = so.id
+                %s
+                INNER JOIN product_product pp ON sol.product_id = pp.id
+                INNER JOIN product_template pt ON pp.product_tmpl_id = pt.id
+            WHERE 
+                so.state IN ('sale', 'done')
+            GROUP BY 
+                sol.product_id,
+                DATE(so.date_order),
+                TO_CHAR(so.date_order, 'YYYY'),
+                TO_CHAR(so.date_order, 'YYYY-MM'),
+                TO_CHAR(so.date_order, 'Q'),
+                so.partner_id,
+                so.user_id,
+                so.team_id,
+                so.company_id
+        """, SQL.identifier(FACT_TABLE), day_join))
+        row_count = cr.rowcount
+        
+        cr.execute(SQL("""
+            INSERT INTO %s (product_id, day, qty)
+            SELECT product_id, order_date, SUM(qty_sold)
+            FROM %s
+            %s
+            GROUP BY product_id, order_date
+        """, SQL.identifier(DEMAND_TABLE), SQL.identifier(FACT_TABLE), day_filter))
+        cr.execute(SQL("UPDATE %s SET version = version + 1", SQL.identifier(VERSION_TABLE)))
+        _logger.info("Tendencias de productos: %s filas recalculadas (%s días)",
+                     row_count, 'todos los' if days is None else len(days))
+
+    @api.model
+    def _mark_orders_dirty(self, order_ids):
+        """Marca para recalcular los días de las órdenes indicadas"""
+        if not order_ids:
+            return
+        self.env['sale.order'].flush_model(['date_order'])
+        self.env.cr.execute(SQL("""
+            INSERT INTO %s (day)
+            SELECT DISTINCT DATE(date_order)
+            FROM sale_order
+            WHERE id = ANY(%s) AND date_order IS NOT NULL
+            ON CONFLICT DO NOTHING
+        """, SQL.identifier(DIRTY_TABLE), list(order_ids)))
+        precommit = self.env.cr.precommit
+        if not self.env.cr.rowcount or precommit.data.get(DIRTY_TABLE):
+            return  # Días ya pendientes, o cron ya disparado en esta transacción
+        cron = self.env.ref('lionsceller_crm.ir_cron_product_trend_refresh', raise_if_not_found=False)
+        if cron:
+            # Un solo disparo por transacción, aunque se editen cientos de líneas
+            precommit.data[DIRTY_TABLE] = True
+            precommit.add(cron.sudo()._trigger)
+
+    @api.model
+    def _cron_refresh_facts(self):
+        """Recalcula los días pendientes de la tabla de hechos"""
+        self.env.cr.execute(SQL("DELETE FROM %s RETURNING day", SQL.identifier(DIRTY_TABLE)))
+        days = [row[0] for row in self.env.cr.fetchall()]
+        if days:
+            self._refresh_facts(days)
+            # El consumo cambió: el resumen de inventarios mín/máx deja de ser válido
+            self.env['stock.minmax.report']._bump_version()
 
     @api.model
     def get_top_trending_products(self, limit=10, days=30):
-        """Obtiene los productos con mayor tendencia en los últimos días"""
+        """
+        Obtiene los productos con mayor tendencia en los últimos días
+
+        El resultado se reutiliza por compañías, días, límite e idioma
+        durante TOP_TRENDING_TTL segundos, o hasta que el recálculo de la
+        tabla de hechos (al confirmar o modificar órdenes) cambie su versión.
+        """
+        limit, days = int(limit), int(days)
+        company_ids = tuple(sorted(self.env.companies.ids))
         date_from = fields.Date.today() - timedelta(days=days)
         
-        query = """
+        self.env.cr.execute(SQL("SELECT version FROM %s", SQL.identifier(VERSION_TABLE)))
+        row = self.env.cr.fetchone()
+        key = (self.env.cr.dbname, row[0] if row else 0, company_ids, days, limit, date_from, self.env.lang)
+        trending_data = top_trending_cache.get(key)
+        if trending_data is not None:
+            return [dict(item) for item in trending_data]
+        
+        self.env.cr.execute(SQL("""
             SELECT 
                 product_id,
-                SUM(qty_sold) as total_qty,
-                SUM(total_revenue) as total_rev,
-                COUNT(*) as freq
+                SUM(qty_sold) AS total_qty,
+                SUM(total_revenue) AS total_rev,
+                COUNT(*) AS freq
             FROM %s
-            WHERE order_date >= '%s'
+            WHERE order_date >= %s
+              AND company_id = ANY(%s)
             GROUP BY product_id
             ORDER BY total_rev DESC
             LIMIT %s
-        """ % (self._table, date_from, limit)
-        
-        self.env.cr.execute(query)
+        """, SQL.identifier(FACT_TABLE), date_from, list(company_ids), limit))
         results = self.env.cr.dictfetchall()
         
+        # Nombre y código de todos los productos en una sola lectura
+        products = self.env['product.product'].browse([row['product_id'] for row in results])
+        product_info = {product['id']: product for product in products.read(['name', 'default_code'])}
+        
         trending_data = []
         for row in results:
-            product = self.env['product.product'].browse(row['product_id'])
+            product = product_info.get(row['product_id'], {})
             trending_data.append({
-                'product_name': product.name,
-                'product_code': product.default_code or 'N/A',
+                'product_name': product.get('name'),
+                'product_code': product.get('default_code') or 'N/A',
                 'qty_sold': row['total_qty'],
                 'revenue': row['total_rev'],
                 'frequency': row['freq'],
             })
         
-        return trending_data
+        top_trending_cache.set(key, tuple(trending_data))
+        return [dict(item) for item in trending_data]
 
     @api.model
     def get_sales_forecast(self, product_id, months_ahead=3):
-        """Proyección simple de ventas basada en promedio histórico"""
-        historical = self.search([
-            ('product_id', '=', product_id),
-            ('order_date', '>=', fields.Date.today() - timedelta(days=180))
-        ])
-        
-        if not historical:
-            return {'forecast': 0, 'confidence': 'low'}
-        
-        avg_monthly_sales = sum(historical.mapped('qty_sold')) / 6  # 6 meses
-        forecast = avg_monthly_sales * months_ahead
-        
-        # Calcular confianza basada en variabilidad
-        qty_values = historical.mapped('qty_sold')
-        if len(qty_values) > 1:
-            import statistics
-            std_dev = statistics.stdev(qty_values)
-            cv = (std_dev / avg_monthly_sales) if avg_monthly_sales > 0 else 0
-            
-            if cv < 0.3:
-                confidence = 'high'
-            elif cv < 0.6:
-                confidence = 'medium'
-            else:
-                confidence = 'low'
-        else:
-            confidence = 'low'
-        
-        return {
-            'forecast_qty': round(forecast, 2),
-            'avg_monthly': round(avg_monthly_sales, 2),
-            'confidence': confidence,
-            'months_ahead': months_ahead
-        }
+        """
+        Proyección de ventas del producto con intervalo de confianza del 95%
+
+        Lee el pronóstico precalculado en product.sales.forecast (suavizado
+        de Holt sobre la demanda mensual de todo el catálogo).
+        """
+        return self.env['product.sales.forecast']._get_forecast(product_id, months_ahead)
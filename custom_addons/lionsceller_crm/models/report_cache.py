@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Caché en memoria para resultados de reportes
+
+Cada worker guarda sus propios resultados; quien la usa incluye en la
+clave una versión leída de la base de datos para descartarlos cuando los
+datos cambian en cualquier proceso.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """LRU en memoria con expiración, compartido por los hilos del worker"""
+
+    def __init__(self, maxsize=256, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
@@ -7,12 +7,19 @@ class ResConfigSettings(models.TransientModel):
     lead_assignment_strategy = fields.Selection([
         ('round_robin', 'Round Robin (Rotación)'),
         ('random', 'Random (Aleatorio)'),
-        ('load_based', 'Load-Based (Por Carga de Trabajo)')
+        ('load_based', 'Load-Based (Por Carga de Trabajo)'),
+        ('capacity', 'Capacidad y Territorio'),
     ], string='Estrategia de Asignación de Leads',
        default='round_robin',
        config_parameter='lionsceller_crm.lead_assignment_strategy',
        help='Selecciona cómo se asignarán automáticamente los asesores a los nuevos leads.')
     
+    auto_lead_defer_imports = fields.Boolean(
+        string='Oportunidades Diferidas en Importaciones',
+        config_parameter='lionsceller_crm.auto_lead_defer_imports',
+        help='Al importar contactos, las oportunidades automáticas se crean en segundo plano por bloques '
+             'en lugar de dentro de la importación.')
+    
     # WhatsApp Cloud API Configuration
     whatsapp_test_mode = fields.Boolean(
         string='Modo de Prueba',
@@ -39,3 +46,46 @@ class ResConfigSettings(models.TransientModel):
         default='LIONSCELLER_SECRET_TOKEN',
         help='Token de verificación del webhook (debe coincidir con el configurado en Meta)'
     )
+    
+    whatsapp_api_url = fields.Char(
+        string='URL del Graph API',
+        config_parameter='lionsceller_crm.whatsapp_api_url',
+        default='https://graph.facebook.com/v18.0',
+        help='URL base de Meta Cloud API (puede apuntar a un servidor local para pruebas)'
+    )
+    
+    whatsapp_messages_per_second = fields.Selection([
+        ('80', 'Estándar (80 mensajes/seg)'),
+        ('1000', 'Alto (1,000 mensajes/seg)'),
+    ], string='Nivel de Throughput',
+       default='80',
+       config_parameter='lionsceller_crm.whatsapp_messages_per_second',
+       help='Mensajes por segundo permitidos por Meta para el número de WhatsApp Business')
+    
+    whatsapp_log_sample_rate = fields.Float(
+        string='Muestreo de Logs del Webhook',
+        config_parameter='lionsceller_crm.whatsapp_log_sample_rate',
+        default=0.01,
+        help='Fracción de peticiones del webhook que se registran en el log (0.01 = 1%, 1 = todas)'
+    )
+    
+    whatsapp_log_payload_max = fields.Integer(
+        string='Máximo de Caracteres del Payload en Logs',
+        config_parameter='lionsceller_crm.whatsapp_log_payload_max',
+        default=512,
+        help='El payload se trunca a esta longitud y los números de teléfono se enmascaran'
+    )
+    
+    whatsapp_thread_window_hours = fields.Integer(
+        string='Ventana de Conversación (horas)',
+        config_parameter='lionsceller_crm.whatsapp_thread_window_hours',
+        default=72,
+        help='Los mensajes de un contacto con una oportunidad abierta y activa en este periodo '
+             'se agregan a esa oportunidad. 0 = crear siempre una oportunidad nueva'
+    )
+
+    def set_values(self):
+        super().set_values()
+        # Invalida el snapshot cacheado de whatsapp.helper._get_config y la
+        # estrategia del contexto de asignación de crm.lead
+        self.env.registry.clear_cache()
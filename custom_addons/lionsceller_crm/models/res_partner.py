@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 import logging
+import threading
 from odoo import api, fields, models, _
+from odoo.tools.sql import column_exists, create_column
+
+from .whatsapp_helper import normalize_phone
 
 _logger = logging.getLogger(__name__)
 
@@ -8,6 +12,99 @@ _logger = logging.getLogger(__name__)
 class Partner(models.Model):
     _inherit = 'res.partner'
 
+    # Claves E.164 para búsquedas exactas por teléfono (webhook y whatsapp.helper)
+    phone_e164 = fields.Char(
+        string='Teléfono Normalizado', compute='_compute_phone_e164',
+        store=True, index='btree_not_null', readonly=True)
+    mobile_e164 = fields.Char(
+        string='Móvil Normalizado', compute='_compute_phone_e164',
+        store=True, index='btree_not_null', readonly=True)
+
+    def _auto_init(self):
+        """
+        Crea las columnas normalizadas antes que el ORM para que la
+        instalación no las calcule sobre todos los contactos; los registros
+        existentes se rellenan con el cron _cron_backfill_phone_e164.
+        """
+        for column in ('phone_e164', 'mobile_e164'):
+            if not column_exists(self.env.cr, self._table, column):
+                create_column(self.env.cr, self._table, column, 'varchar')
+        return super()._auto_init()
+
+    @api.depends('phone', 'mobile')
+    def _compute_phone_e164(self):
+        for partner in self:
+            partner.phone_e164 = normalize_phone(partner.phone)
+            partner.mobile_e164 = normalize_phone(partner.mobile)
+
+    @api.model
+    def _find_by_phone_e164(self, keys):
+        """
+        Resuelve varios teléfonos normalizados con una sola consulta
+
+        :param keys: claves E.164 (ver whatsapp_helper.normalize_phone)
+        :return: dict {clave: contacto}; el teléfono tiene prioridad sobre el móvil
+        """
+        keys = {key for key in keys if key}
+        if not keys:
+            return {}
+        partners = self.search([
+            '|', ('phone_e164', 'in', list(keys)), ('mobile_e164', 'in', list(keys)),
+        ])
+        result = {}
+        for field_name in ('phone_e164', 'mobile_e164'):
+            for partner in partners:
+                key = partner[field_name]
+                if key in keys and key not in result:
+                    result[key] = partner
+        return result
+
+    @api.model
+    def _cron_backfill_phone_e164(self, batch_size=5000, max_batches=20):
+        """Rellena por lotes las claves normalizadas de los contactos existentes"""
+        ICP = self.env['ir.config_parameter'].sudo()
+        last_id = int(ICP.get_param('lionsceller_crm.phone_e164_backfill_last_id', '0'))
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        processed = 0
+
+        for __ in range(max_batches):
+            self.env.cr.execute("""
+                SELECT id, phone, mobile
+                FROM res_partner
+                WHERE id > %s AND (phone IS NOT NULL OR mobile IS NOT NULL)
+                ORDER BY id
+                LIMIT %s
+            """, [last_id, batch_size])
+            rows = self.env.cr.fetchall()
+            if not rows:
+                _logger.info("Backfill de teléfonos normalizados terminado")
+                # El scheduler desactiva el cron al terminar esta ejecución;
+                # escribir en el cron en curso fallaría por su bloqueo
+                self.env['ir.cron']._notify_progress(done=processed, remaining=0, deactivate=True)
+                break
+
+            self.env.cr.execute("""
+                UPDATE res_partner p
+                SET phone_e164 = v.phone_e164, mobile_e164 = v.mobile_e164
+                FROM (
+                    SELECT UNNEST(%s::int[]) AS id,
+                           UNNEST(%s::varchar[]) AS phone_e164,
+                           UNNEST(%s::varchar[]) AS mobile_e164
+                ) v
+                WHERE p.id = v.id
+            """, [
+                [row[0] for row in rows],
+                [normalize_phone(row[1]) or None for row in rows],
+                [normalize_phone(row[2]) or None for row in rows],
+            ])
+            last_id = rows[-1][0]
+            processed += len(rows)
+            ICP.set_param('lionsceller_crm.phone_e164_backfill_last_id', str(last_id))
+            if auto_commit:
+                self.env.cr.commit()
+
+        self.invalidate_model(['phone_e164', 'mobile_e164'])
+
     @api.model_create_multi
     def create(self, vals_list):
         """
@@ -16,48 +113,76 @@ class Partner(models.Model):
         2. Crea una oportunidad automáticamente
         """
         partners = super(Partner, self).create(vals_list)
+        if partners._defer_auto_opportunities():
+            top_level = partners.filtered(lambda p: not p.parent_id)
+            if top_level:
+                self.env['res.partner.auto.lead.job'].enqueue(top_level)
+        else:
+            partners._create_auto_opportunities()
+        return partners
+
+    def _defer_auto_opportunities(self):
+        """
+        Las oportunidades se crean en segundo plano si el contexto trae
+        defer_auto_lead, o en importaciones cuando está activa la opción
+        lionsceller_crm.auto_lead_defer_imports. La creación interactiva
+        sigue siendo síncrona.
+        """
+        defer = self.env.context.get('defer_auto_lead')
+        if defer is None:
+            defer = self.env.context.get('import_file') and self.env['ir.config_parameter'].sudo().get_param(
+                'lionsceller_crm.auto_lead_defer_imports')
+        return bool(defer)
+
+    def _create_auto_opportunities(self):
+        """
+        Asigna asesor a los contactos que no lo tienen y les crea su
+        oportunidad, todo por lote.
+        :return: crm.lead creados
+        """
+        # Solo procesar contactos que no son hijos de una empresa
+        top_level = self.filtered(lambda p: not p.parent_id)
+        leads = self.env['crm.lead']
+        if not top_level:
+            return leads
         
-        for partner in partners:
-            _logger.info(f"Partner creado: {partner.name}, user_id: {partner.user_id}, parent_id: {partner.parent_id}")
+        # Si no tiene asesor asignado, asignar el primero disponible
+        # (primer usuario de ventas por nombre, buscado una sola vez por lote)
+        without_user = top_level.filtered(lambda p: not p.user_id)
+        if without_user:
+            salesperson = self.env['res.users'].search([
+                ('share', '=', False),  # No es usuario portal
+                ('groups_id', 'in', self.env.ref('sales_team.group_sale_salesman').id)
+            ], limit=1)
+            if salesperson:
+                without_user.write({'user_id': salesperson.id})
+                _logger.info("Asesor asignado automáticamente a %s contactos (user_id: %s)",
+                             len(without_user), salesperson.id)
+        
+        # Crear oportunidad si tiene asesor (asignado manual o automáticamente)
+        teams_by_user = {}
+        lead_vals_list = []
+        for partner in top_level.filtered('user_id'):
+            # Equipo de ventas del asesor, una vez por asesor
+            user_id = partner.user_id.id
+            if user_id not in teams_by_user:
+                teams_by_user[user_id] = self.env['crm.team']._get_default_team_id(user_id=user_id).id
             
-            # Solo procesar si no es un contacto hijo de una empresa
-            if not partner.parent_id:
-                # Si no tiene asesor asignado, asignar el primero disponible
-                if not partner.user_id:
-                    # Buscar el primer usuario con permisos de ventas
-                    salesperson = self.env['res.users'].search([
-                        ('share', '=', False),  # No es usuario portal
-                        ('groups_id', 'in', self.env.ref('sales_team.group_sale_salesman').id)
-                    ], limit=1)
-                    
-                    if salesperson:
-                        partner.user_id = salesperson.id
-                        _logger.info(f"Asesor asignado automáticamente: {salesperson.name} a {partner.name}")
-                
-                # Crear oportunidad si tiene asesor (asignado manual o automáticamente)
-                if partner.user_id:
-                    _logger.info(f"Creando oportunidad automática para {partner.name}")
-                    
-                    # Buscar equipo de ventas del asesor
-                    team = self.env['crm.team']._get_default_team_id(
-                        user_id=partner.user_id.id
-                    )
-                    
-                    # Crear la oportunidad automáticamente
-                    lead_vals = {
-                        'name': _("Oportunidad de %s") % partner.name,
-                        'partner_id': partner.id,
-                        'user_id': partner.user_id.id,
-                        'team_id': team.id if team else False,
-                        'type': 'opportunity',
-                        'email_from': partner.email,
-                        'phone': partner.phone or partner.mobile,
-                        'contact_name': partner.name,
-                        'description': _('Oportunidad creada automáticamente al registrar el contacto'),
-                        'priority': '1',
-                    }
-                    
-                    lead = self.env['crm.lead'].create(lead_vals)
-                    _logger.info(f"Oportunidad creada: {lead.name} (ID: {lead.id}) - Asesor: {partner.user_id.name}")
+            lead_vals_list.append({
+                'name': _("Oportunidad de %s") % partner.name,
+                'partner_id': partner.id,
+                'user_id': user_id,
+                'team_id': teams_by_user[user_id] or False,
+                'type': 'opportunity',
+                'email_from': partner.email,
+                'phone': partner.phone or partner.mobile,
+                'contact_name': partner.name,
+                'description': _('Oportunidad creada automáticamente al registrar el contacto'),
+                'priority': '1',
+            })
         
-        return partners
+        if lead_vals_list:
+            # Todas llevan asesor, así que no pasan por la asignación automática
+            leads = leads.create(lead_vals_list)
+            _logger.info("Oportunidades creadas automáticamente: %s", len(leads))
+        return leads
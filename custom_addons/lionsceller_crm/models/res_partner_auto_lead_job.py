@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+
+from odoo import api, fields, models, _
+from odoo.exceptions import AccessError
+
+_logger = logging.getLogger(__name__)
+
+
+class PartnerAutoLeadJob(models.Model):
+    """Creación diferida de oportunidades automáticas
+
+    En importaciones masivas res.partner.create solo registra aquí los
+    contactos nuevos; un cron crea sus oportunidades por bloques,
+    confirmando la transacción y el avance tras cada bloque.
+    """
+    _name = 'res.partner.auto.lead.job'
+    _description = 'Creación Diferida de Oportunidades'
+    _order = 'id desc'
+
+    partner_ids = fields.Many2many(
+        'res.partner', 'res_partner_auto_lead_job_rel', 'job_id', 'partner_id',
+        string='Contactos', readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pendiente'),
+        ('running', 'En Proceso'),
+        ('done', 'Terminado'),
+        ('error', 'Error'),
+    ], string='Estado', default='pending', required=True, index=True, readonly=True)
+    total_count = fields.Integer(string='Contactos', readonly=True)
+    processed_count = fields.Integer(string='Procesados', readonly=True)
+    lead_count = fields.Integer(string='Oportunidades Creadas', readonly=True)
+    progress = fields.Float(string='Avance', compute='_compute_progress')
+    last_partner_id = fields.Integer(string='Último Contacto Procesado', readonly=True)
+    started_at = fields.Datetime(string='Iniciado el', readonly=True)
+    finished_at = fields.Datetime(string='Terminado el', readonly=True)
+    last_error = fields.Text(string='Último Error', readonly=True)
+
+    @api.depends('processed_count', 'total_count')
+    def _compute_progress(self):
+        for job in self:
+            job.progress = 100.0 * job.processed_count / job.total_count if job.total_count else 0.0
+
+    @api.model
+    def enqueue(self, partners):
+        """Registra los contactos para crear sus oportunidades en segundo plano"""
+        job = self.sudo().create({
+            'partner_ids': [fields.Command.set(partners.ids)],
+            'total_count': len(partners),
+        })
+        cron = self.env.ref('lionsceller_crm.ir_cron_partner_auto_lead_job', raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+        return job
+
+    def action_retry(self):
+        """Reanuda los trabajos con error desde el último bloque confirmado"""
+        # Los gerentes solo leen los trabajos; el reintento se escribe con sudo
+        if not self.env.user.has_group('sales_team.group_sale_manager'):
+            raise AccessError(_("Solo los gerentes de ventas pueden reintentar trabajos."))
+        self.sudo().filtered(lambda j: j.state == 'error').write({'state': 'pending', 'last_error': False})
+        cron = self.env.ref('lionsceller_crm.ir_cron_partner_auto_lead_job', raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+
+    @api.model
+    def _cron_process_jobs(self, chunk_size=1000, max_chunks=50):
+        """Procesa los trabajos pendientes por bloques, confirmando tras cada bloque"""
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        chunks = 0
+        while chunks < max_chunks:
+            job = self._claim_job()
+            if not job:
+                break
+            while chunks < max_chunks and job.state == 'running':
+                job._process_chunk(chunk_size)
+                chunks += 1
+                if auto_commit:
+                    self.env.cr.commit()
+        if chunks >= max_chunks and self.search_count([('state', 'in', ('pending', 'running'))], limit=1):
+            # Queda trabajo: volver a ejecutar en cuanto termine esta corrida
+            self.env.ref('lionsceller_crm.ir_cron_partner_auto_lead_job')._trigger()
+
+    @api.model
+    def _claim_job(self):
+        """Bloquea el trabajo más antiguo sin terminar sin esperar a otros workers"""
+        self.env.cr.execute("""
+            SELECT id
+            FROM res_partner_auto_lead_job
+            WHERE state IN ('pending', 'running')
+            ORDER BY id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        """)
+        row = self.env.cr.fetchone()
+        job = self.browse(row[0] if row else [])
+        if job and job.state == 'pending':
+            job.write({'state': 'running', 'started_at': fields.Datetime.now()})
+        return job
+
+    def _process_chunk(self, chunk_size):
+        """Crea las oportunidades del siguiente bloque de contactos del trabajo"""
+        self.ensure_one()
+        self.env.cr.execute("""
+            SELECT partner_id
+            FROM res_partner_auto_lead_job_rel
+            WHERE job_id = %s AND partner_id > %s
+            ORDER BY partner_id
+            LIMIT %s
+        """, [self.id, self.last_partner_id, chunk_size])
+        partner_ids = [row[0] for row in self.env.cr.fetchall()]
+        if not partner_ids:
+            self.write({'state': 'done', 'finished_at': fields.Datetime.now()})
+            _logger.info("Oportunidades diferidas: trabajo %s terminado, %s oportunidades",
+                         self.id, self.lead_count)
+            return
+
+        try:
+            with self.env.cr.savepoint():
+                leads = self.env['res.partner'].browse(partner_ids).exists()._create_auto_opportunities()
+        except Exception as e:
+            _logger.exception("Oportunidades diferidas: error en el trabajo %s", self.id)
+            self.write({'state': 'error', 'last_error': str(e)})
+            return
+
+        self.write({
+            'processed_count': self.processed_count + len(partner_ids),
+            'lead_count': self.lead_count + len(leads),
+            'last_partner_id': partner_ids[-1],
+        })
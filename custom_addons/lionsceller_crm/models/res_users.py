@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from odoo import api, fields, models
+
+# Cambios que alteran quién recibe leads (contexto cacheado en crm.lead)
+ASSIGNMENT_FIELDS = {
+    'active', 'share', 'groups_id', 'lead_assignment_paused', 'lead_capacity_weight',
+    'lead_max_open', 'lead_country_ids', 'lead_city_names', 'lead_skill_categ_ids',
+}
+
+
+class ResUsers(models.Model):
+    _inherit = 'res.users'
+
+    lead_assignment_paused = fields.Boolean(
+        string='Fuera de Oficina',
+        help='No asignar leads nuevos automáticamente a este asesor')
+
+    # Asignación por capacidad y territorio
+    lead_capacity_weight = fields.Float(
+        string='Capacidad Relativa', default=1.0,
+        help='Proporción de leads que recibe frente a un asesor de tiempo completo (1.0); '
+             'por ejemplo 0.5 para medio tiempo. 0 lo excluye de la asignación por capacidad.')
+    lead_max_open = fields.Integer(
+        string='Máximo de Leads Abiertos',
+        help='No asignar más leads automáticamente al alcanzar este número de oportunidades abiertas (0 = sin límite)')
+    lead_country_ids = fields.Many2many(
+        'res.country', 'res_users_lead_country_rel', 'user_id', 'country_id',
+        string='Países Atendidos')
+    lead_city_names = fields.Char(
+        string='Ciudades Atendidas',
+        help='Ciudades separadas por comas; tienen prioridad sobre los países')
+    lead_skill_categ_ids = fields.Many2many(
+        'product.category', 'res_users_lead_skill_categ_rel', 'user_id', 'categ_id',
+        string='Especialidad de Productos',
+        help='Categorías de producto (y sus subcategorías) en las que se especializa el asesor')
+
+    @property
+    def SELF_WRITEABLE_FIELDS(self):
+        return super().SELF_WRITEABLE_FIELDS + ['lead_assignment_paused']
+
+    def _affects_lead_assignment(self):
+        """True si alguno de los usuarios es interno y del grupo de vendedores"""
+        return any(not user.share and user.has_group('sales_team.group_sale_salesman') for user in self.sudo())
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        users = super().create(vals_list)
+        if users._affects_lead_assignment():
+            self.env['crm.lead']._invalidate_assignment_context()
+        return users
+
+    def write(self, vals):
+        if not ASSIGNMENT_FIELDS.intersection(vals):
+            return super().write(vals)
+        # Antes y después: el cambio puede sacar o meter al usuario en el grupo
+        relevant = self._affects_lead_assignment()
+        res = super().write(vals)
+        if relevant or self._affects_lead_assignment():
+            self.env['crm.lead']._invalidate_assignment_context()
+        return res
+
+
+class ResGroups(models.Model):
+    _inherit = 'res.groups'
+
+    def write(self, vals):
+        res = super().write(vals)
+        if 'users' in vals:
+            sales_group = self.env.ref('sales_team.group_sale_salesman', raise_if_not_found=False)
+            if sales_group and sales_group in (self | self.trans_implied_ids):
+                self.env['crm.lead']._invalidate_assignment_context()
+        return res
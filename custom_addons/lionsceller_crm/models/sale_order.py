@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from odoo import api, models
+
+# Campos que cambian los hechos de tendencias de productos
+TREND_ORDER_FIELDS = {'state', 'date_order', 'partner_id', 'user_id', 'team_id'}
+TREND_LINE_FIELDS = {'product_id', 'product_uom_qty', 'price_unit', 'discount', 'tax_id', 'order_id'}
+
+CONFIRMED_STATES = ('sale', 'done')
+
+
+class SaleOrder(models.Model):
+    _inherit = 'sale.order'
+
+    def _mark_trend_dirty(self):
+        """Marca los días de las órdenes confirmadas para recalcular las tendencias"""
+        confirmed = self.filtered(lambda o: o.state in CONFIRMED_STATES)
+        if confirmed:
+            self.env['product.trend.report'].sudo()._mark_orders_dirty(confirmed.ids)
+
+    def write(self, vals):
+        track = TREND_ORDER_FIELDS.intersection(vals)
+        if track:
+            # Días anteriores (fecha o estado previos) y posteriores al cambio
+            self._mark_trend_dirty()
+        res = super().write(vals)
+        if track:
+            self._mark_trend_dirty()
+        return res
+
+    def unlink(self):
+        self._mark_trend_dirty()
+        return super().unlink()
+
+
+class SaleOrderLine(models.Model):
+    _inherit = 'sale.order.line'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        lines = super().create(vals_list)
+        lines.order_id._mark_trend_dirty()
+        return lines
+
+    def write(self, vals):
+        if 'order_id' in vals:
+            self.order_id._mark_trend_dirty()
+        res = super().write(vals)
+        if TREND_LINE_FIELDS.intersection(vals):
+            self.order_id._mark_trend_dirty()
+        return res
+
+    def unlink(self):
+        self.order_id._mark_trend_dirty()
+        return super().unlink()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Pronóstico de demanda por lotes
+
+Ajusta suavizado exponencial de Holt (nivel + tendencia) a la demanda
+mensual de todos los productos a la vez: cada paso del tiempo es una
+operación de NumPy sobre la matriz productos × combinaciones de
+parámetros, y cada producto se queda con el par (alpha, beta) de menor
+error cuadrático. No usa el ORM.
+"""
+import math
+
+import numpy as np
+
+DEFAULT_ALPHAS = (0.1, 0.2, 0.3, 0.5, 0.7)
+DEFAULT_BETAS = (0.05, 0.1, 0.2, 0.3)
+# z de la distribución normal para el intervalo de confianza del 95%
+Z_95 = 1.96
+
+
+def fit_holt(demand, start, alphas=DEFAULT_ALPHAS, betas=DEFAULT_BETAS):
+    """
+    Ajusta Holt a cada fila de `demand`
+
+    :param demand: matriz (productos, meses) de demanda mensual
+    :param start: índice del primer mes con ventas de cada producto
+    :return: dict de arreglos por producto: level, trend, sigma, alpha,
+             beta y history (meses observados desde el primero con ventas)
+    """
+    demand = np.asarray(demand, dtype=float)
+    start = np.asarray(start, dtype=int)
+    n_products, n_months = demand.shape
+    grid_alpha, grid_beta = (g.ravel()[:, None] for g in np.meshgrid(alphas, betas, indexing='ij'))
+
+    shape = (grid_alpha.shape[0], n_products)
+    level = np.zeros(shape)
+    trend = np.zeros(shape)
+    sse = np.zeros(shape)
+    for t in range(n_months):
+        y = demand[:, t]
+        first = start == t
+        active = start < t
+        prediction = level + trend
+        error = np.where(active, y - prediction, 0.0)
+        sse += error ** 2
+        new_level = grid_alpha * y + (1 - grid_alpha) * prediction
+        new_trend = grid_beta * (new_level - level) + (1 - grid_beta) * trend
+        level = np.where(first, y, np.where(active, new_level, level))
+        trend = np.where(active, new_trend, trend)
+
+    best = np.argmin(sse, axis=0)
+    columns = np.arange(n_products)
+    history = np.clip(n_months - start, 0, None)
+    return {
+        'level': level[best, columns],
+        'trend': trend[best, columns],
+        'sigma': np.sqrt(sse[best, columns] / np.maximum(history - 2, 1)),
+        'alpha': grid_alpha[best, 0],
+        'beta': grid_beta[best, 0],
+        'history': history,
+    }
+
+
+def holt_horizon(level, trend, sigma, alpha, beta, months, z=Z_95):
+    """
+    Demanda acumulada de los próximos `months` meses con su intervalo
+
+    Funciona con escalares o arreglos. El intervalo es el de la suma: el
+    error del mes j+1 arrastra los errores de los meses anteriores, así que
+    la varianza es sigma² Σ_j (1 + Σ_{k≤j} α(1 + kβ))², con j = 0..months-1.
+    :return: (pronóstico, límite inferior, límite superior), sin negativos
+    """
+    total = 0.0
+    variance = 0.0
+    for h in range(1, months + 1):
+        total = total + np.maximum(level + h * trend, 0.0)
+        j = h - 1
+        carried = alpha * (j + beta * j * (j + 1) / 2.0)
+        variance = variance + sigma ** 2 * (1 + carried) ** 2
+    margin = z * np.sqrt(variance)
+    return total, np.maximum(total - margin, 0.0), total + margin
+
+
+def confidence_level(sigma, level, history):
+    """Confianza según el coeficiente de variación del error: high, medium o low"""
+    if history < 3 or level <= 0 or math.isnan(sigma):
+        return 'low'
+    cv = sigma / level
+    if cv < 0.3:
+        return 'high'
+    if cv < 0.6:
+        return 'medium'
+    return 'low'
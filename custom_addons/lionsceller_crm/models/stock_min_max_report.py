@@ -1,6 +1,20 @@
 # -*- coding: utf-8 -*-
 from odoo import models, fields, api, tools
-from datetime import datetime, timedelta
+from odoo.tools import SQL
+
+from .product_trend_report import DEMAND_TABLE
+from .report_cache import TTLCache
+
+# Existencias por producto en ubicaciones internas
+ONHAND_TABLE = 'stock_minmax_onhand'
+
+# Contador de movimientos de stock validados; forma parte de la clave del resumen
+VERSION_SEQUENCE = 'stock_minmax_report_version'
+
+# Segundos que se reutiliza el resumen del tablero de inventarios
+STOCK_SUMMARY_TTL = 60
+
+stock_summary_cache = TTLCache(maxsize=64, ttl=STOCK_SUMMARY_TTL)
 
 
 class StockMinMaxReport(models.Model):
@@ -23,12 +37,14 @@ class StockMinMaxReport(models.Model):
     # Consumo y Rotación (últimos 90 días)
     avg_daily_consumption = fields.Float(string='Consumo Diario Promedio', readonly=True, digits=(16, 2))
     total_consumption_90d = fields.Float(string='Consumo Total (90 días)', readonly=True, digits=(16, 2))
-    days_of_stock = fields.Float(string='Días de Stock', compute='_compute_stock_metrics', store=False, aggregator='avg')
+    days_of_stock = fields.Float(string='Días de Stock', readonly=True, aggregator='avg')
     
     # Inventarios Calculados
-    min_stock = fields.Float(string='Stock Mínimo', compute='_compute_min_max', store=False, digits=(16, 2), aggregator='sum')
-    max_stock = fields.Float(string='Stock Máximo', compute='_compute_min_max', store=False, digits=(16, 2), aggregator='sum')
-    reorder_point = fields.Float(string='Punto de Reorden', compute='_compute_min_max', store=False, digits=(16, 2), aggregator='sum')
+    min_stock = fields.Float(string='Stock Mínimo', readonly=True, digits=(16, 2), aggregator='sum')
+    max_stock = fields.Float(string='Stock Máximo', readonly=True, digits=(16, 2), aggregator='sum')
+    reorder_point = fields.Float(string='Punto de Reorden', readonly=True, digits=(16, 2), aggregator='sum')
+    safety_stock = fields.Float(string='Stock de Seguridad', readonly=True, digits=(16, 2), aggregator='sum')
+    service_level = fields.Float(string='Nivel de Servicio (%)', readonly=True, aggregator='avg')
     
     # Alertas y Recomendaciones
     stock_status = fields.Selection([
@@ -38,183 +54,313 @@ class StockMinMaxReport(models.Model):
         ('low', '🔴 Stock Bajo'),
         ('critical', '🚨 Crítico'),
         ('stockout', '❌ Sin Stock'),
-    ], string='Estado', compute='_compute_stock_metrics', store=False)
+    ], string='Estado', readonly=True)
     
-    alert_level = fields.Integer(string='Nivel de Alerta', compute='_compute_stock_metrics', store=False)
-    qty_to_order = fields.Float(string='Cantidad a Ordenar', compute='_compute_stock_metrics', store=False, digits=(16, 2), aggregator='sum')
+    alert_level = fields.Integer(string='Nivel de Alerta', readonly=True, aggregator='max')
+    qty_to_order = fields.Float(string='Cantidad a Ordenar', readonly=True, digits=(16, 2), aggregator='sum')
     
     # Costos
     standard_price = fields.Float(string='Costo Unitario', readonly=True, digits=(16, 2))
-    stock_value = fields.Float(string='Valor en Stock', compute='_compute_stock_metrics', store=False, digits=(16, 2), aggregator='sum')
-
-    @api.depends('qty_available', 'avg_daily_consumption', 'standard_price')
-    def _compute_stock_metrics(self):
-        """Calcula métricas de stock y alertas"""
-        for record in self:
-            # Días de stock disponible
-            if record.avg_daily_consumption > 0:
-                record.days_of_stock = record.qty_available / record.avg_daily_consumption
-            else:
-                record.days_of_stock = 999  # Sin consumo = infinito
-            
-            # Valor del inventario
-            record.stock_value = record.qty_available * record.standard_price
-            
-            # Determinar estado y nivel de alerta
-            min_stock = record.min_stock
-            max_stock = record.max_stock
-            reorder = record.reorder_point
-            
-            if record.qty_available <= 0:
-                record.stock_status = 'stockout'
-                record.alert_level = 5
-                record.qty_to_order = max_stock
-            elif record.qty_available < min_stock:
-                record.stock_status = 'critical'
-                record.alert_level = 4
-                record.qty_to_order = max_stock - record.qty_available
-            elif record.qty_available < reorder:
-                record.stock_status = 'low'
-                record.alert_level = 3
-                record.qty_to_order = max_stock - record.qty_available
-            elif record.qty_available <= reorder:
-                record.stock_status = 'reorder'
-                record.alert_level = 2
-                record.qty_to_order = max_stock - record.qty_available
-            elif record.qty_available > max_stock:
-                record.stock_status = 'overstock'
-                record.alert_level = 1
-                record.qty_to_order = 0
-            else:
-                record.stock_status = 'optimal'
-                record.alert_level = 0
-                record.qty_to_order = 0
-
-    @api.depends('avg_daily_consumption')
-    def _compute_min_max(self):
-        """Calcula inventarios mínimos y máximos basados en consumo"""
-        for record in self:
-            # Parámetros configurables
-            lead_time_days = 7  # Tiempo de reabastecimiento
-            safety_stock_days = 3  # Stock de seguridad
-            service_level_days = 30  # Nivel de servicio (1 mes)
-            
-            daily_consumption = record.avg_daily_consumption or 0
-            
-            # Stock Mínimo = (Consumo diario × Lead time) + Stock de seguridad
-            record.min_stock = (daily_consumption * lead_time_days) + (daily_consumption * safety_stock_days)
-            
-            # Punto de Reorden = Stock Mínimo + (Consumo durante lead time)
-            record.reorder_point = record.min_stock + (daily_consumption * lead_time_days * 0.5)
-            
-            # Stock Máximo = Consumo diario × Nivel de servicio
-            record.max_stock = daily_consumption * service_level_days
-            
-            # Si no hay consumo, establecer valores por defecto bajos
-            if daily_consumption == 0:
-                record.min_stock = 10
-                record.reorder_point = 15
-                record.max_stock = 30
+    stock_value = fields.Float(string='Valor en Stock', readonly=True, digits=(16, 2), aggregator='sum')
 
     def init(self):
-        """Crea la vista SQL del reporte"""
-        tools.drop_view_if_exists(self.env.cr, self._table)
+        """
+        Crea la vista SQL del reporte
+
+        Mínimos, máximos, estado y nivel de alerta se calculan en la vista,
+        así se pueden filtrar, ordenar y agrupar en la base de datos.
+        Los niveles vienen de stock.safety.stock (stock de seguridad
+        estadístico con parámetros por producto, proveedor o categoría);
+        mientras un producto no tenga cálculo se usan las reglas fijas:
+        reabastecimiento 7 días, seguridad 3 días, servicio 30 días y
+        10/15/30 sin consumo.
+        Las existencias y el consumo salen de tablas resumidas por producto
+        (stock_minmax_onhand y product_demand_daily), no de los quants y
+        líneas de venta.
+        """
+        cr = self.env.cr
+        tools.drop_view_if_exists(cr, self._table)
+        cr.execute(SQL("CREATE SEQUENCE IF NOT EXISTS %s", SQL.identifier(VERSION_SEQUENCE)))
+        # Hasta el primer nextval() last_value no cambia: consumirlo aquí
+        cr.execute("SELECT nextval(%s)", [VERSION_SEQUENCE])
+        cr.execute(SQL("""
+            CREATE TABLE IF NOT EXISTS %s (
+                product_id integer PRIMARY KEY,
+                qty_available numeric NOT NULL
+            )
+        """, SQL.identifier(ONHAND_TABLE)))
+        cr.execute(SQL("SELECT 1 FROM %s LIMIT 1", SQL.identifier(ONHAND_TABLE)))
+        if not cr.fetchone():
+            self._refresh_onhand()
         
         query = """
             CREATE OR REPLACE VIEW %s AS (
+                WITH base AS (
+                    SELECT 
+                        pp.id AS id,
+                        pp.id AS product_id,
+                        pt.id AS product_tmpl_id,
+                        pt.categ_id,
+                        pp.default_code,
+                        COALESCE(stock.qty_available, 0) AS qty_available,
+                        COALESCE(stock.qty_available, 0) AS virtual_available,
+                        COALESCE(consumption.total_qty / 90.0, 0) AS avg_daily_consumption,
+                        COALESCE(consumption.total_qty, 0) AS total_consumption_90d,
+                        0.0 AS standard_price,
+                        ss.safety_stock AS ss_safety_stock,
+                        ss.min_stock AS ss_min_stock,
+                        ss.reorder_point AS ss_reorder_point,
+                        ss.max_stock AS ss_max_stock,
+                        ss.service_level AS ss_service_level
+                    FROM 
+                        product_product pp
+                        INNER JOIN product_template pt ON pp.product_tmpl_id = pt.id
+                        LEFT JOIN %s stock ON stock.product_id = pp.id
+                        LEFT JOIN stock_safety_stock ss ON ss.product_id = pp.id
+                        LEFT JOIN (
+                            -- Consumo en los últimos 90 días
+                            SELECT product_id, SUM(qty) AS total_qty
+                            FROM %s
+                            WHERE day >= CURRENT_DATE - 90
+                            GROUP BY product_id
+                        ) consumption ON consumption.product_id = pp.id
+                    WHERE 
+                        pt.active = true
+                        AND pt.type IN ('product', 'consu')
+                ),
+                levels AS (
+                    -- Sin cálculo estadístico:
+                    -- Stock Mínimo = Consumo diario × (Lead time + Stock de seguridad)
+                    -- Punto de Reorden = Stock Mínimo + (Consumo durante medio lead time)
+                    -- Stock Máximo = Consumo diario × Nivel de servicio
+                    SELECT 
+                        b.id, b.product_id, b.product_tmpl_id, b.categ_id, b.default_code,
+                        b.qty_available, b.virtual_available, b.avg_daily_consumption,
+                        b.total_consumption_90d, b.standard_price,
+                        COALESCE(b.ss_safety_stock, 0) AS safety_stock,
+                        b.ss_service_level AS service_level,
+                        COALESCE(b.ss_min_stock,
+                            CASE WHEN b.avg_daily_consumption = 0 THEN 10
+                                 ELSE b.avg_daily_consumption * (7 + 3) END) AS min_stock,
+                        COALESCE(b.ss_reorder_point,
+                            CASE WHEN b.avg_daily_consumption = 0 THEN 15
+                                 ELSE b.avg_daily_consumption * (7 + 3) + b.avg_daily_consumption * 7 * 0.5 END) AS reorder_point,
+                        COALESCE(b.ss_max_stock,
+                            CASE WHEN b.avg_daily_consumption = 0 THEN 30
+                                 ELSE b.avg_daily_consumption * 30 END) AS max_stock
+                    FROM base b
+                ),
+                status AS (
+                    SELECT 
+                        l.*,
+                        CASE
+                            WHEN l.qty_available <= 0 THEN 5
+                            WHEN l.qty_available < l.min_stock THEN 4
+                            WHEN l.qty_available < l.reorder_point THEN 3
+                            WHEN l.qty_available <= l.reorder_point THEN 2
+                            WHEN l.qty_available > l.max_stock THEN 1
+                            ELSE 0
+                        END AS alert_level
+                    FROM levels l
+                )
                 SELECT 
-                    pp.id AS id,
-                    pp.id AS product_id,
-                    pt.id AS product_tmpl_id,
-                    pt.categ_id,
-                    pp.default_code,
-                    COALESCE(stock.qty_available, 0) AS qty_available,
-                    COALESCE(stock.virtual_available, 0) AS virtual_available,
-                    COALESCE(consumption.total_qty / 90.0, 0) AS avg_daily_consumption,
-                    COALESCE(consumption.total_qty, 0) AS total_consumption_90d,
-                    0.0 AS standard_price
-                FROM 
-                    product_product pp
-                    INNER JOIN product_template pt ON pp.product_tmpl_id = pt.id
-                    LEFT JOIN (
-                        -- Stock actual del producto
-                        SELECT 
-                            product_id,
-                            SUM(quantity) AS qty_available,
-                            SUM(quantity) AS virtual_available
-                        FROM stock_quant
-                        WHERE location_id IN (
-                            SELECT id FROM stock_location 
-                            WHERE usage = 'internal'
-                        )
-                        GROUP BY product_id
-                    ) stock ON stock.product_id = pp.id
-                    LEFT JOIN (
-                        -- Consumo en los últimos 90 días
-                        SELECT 
-                            sol.product_id,
-                            SUM(sol.product_uom_qty) AS total_qty
-                        FROM sale_order_line sol
-                        INNER JOIN sale_order so ON sol.order_id = so.id
-                        WHERE 
-                            so.state IN ('sale', 'done')
-                            AND so.date_order >= CURRENT_DATE - INTERVAL '90 days'
-                        GROUP BY sol.product_id
-                    ) consumption ON consumption.product_id = pp.id
-                WHERE 
-                    pt.active = true
-                    AND pt.type IN ('product', 'consu')
+                    s.*,
+                    CASE WHEN s.avg_daily_consumption > 0
+                         THEN s.qty_available / s.avg_daily_consumption
+                         ELSE 999 END AS days_of_stock,
+                    s.qty_available * s.standard_price AS stock_value,
+                    CASE s.alert_level
+                        WHEN 5 THEN 'stockout'
+                        WHEN 4 THEN 'critical'
+                        WHEN 3 THEN 'low'
+                        WHEN 2 THEN 'reorder'
+                        WHEN 1 THEN 'overstock'
+                        ELSE 'optimal'
+                    END AS stock_status,
+                    CASE
+                        WHEN s.alert_level = 5 THEN s.max_stock
+                        WHEN s.alert_level >= 2 THEN s.max_stock - s.qty_available
+                        ELSE 0
+                    END AS qty_to_order
+                FROM status s
             )
-        """ % self._table
+        """ % (self._table, ONHAND_TABLE, DEMAND_TABLE)
         
-        self.env.cr.execute(query)
+        cr.execute(query)
 
     @api.model
     def get_critical_products(self, limit=20):
         """Obtiene productos en estado crítico o sin stock"""
-        return self.search([], order='alert_level desc, qty_available asc', limit=limit)
+        return self.search([('alert_level', '>=', 4)], order='alert_level desc, qty_available asc', limit=limit)
 
     @api.model
-    def get_reorder_suggestions(self):
+    def get_reorder_suggestions(self, limit=None):
         """Genera sugerencias de reorden para productos bajo punto de reorden"""
-        products = self.search([])
+        products = self.search(
+            [('qty_to_order', '>', 0), ('alert_level', '>=', 2)],
+            order='alert_level desc, qty_available asc',
+            limit=limit,
+        )
         suggestions = []
         
         for product in products:
-            if product.qty_to_order > 0 and product.alert_level >= 2:
-                suggestions.append({
-                    'product_id': product.product_id.id,
-                    'product_name': product.product_id.name,
-                    'current_stock': product.qty_available,
-                    'min_stock': product.min_stock,
-                    'max_stock': product.max_stock,
-                    'qty_to_order': product.qty_to_order,
-                    'estimated_cost': product.qty_to_order * product.standard_price,
-                    'alert_level': product.stock_status,
-                })
+            suggestions.append({
+                'product_id': product.product_id.id,
+                'product_name': product.product_id.name,
+                'current_stock': product.qty_available,
+                'min_stock': product.min_stock,
+                'max_stock': product.max_stock,
+                'qty_to_order': product.qty_to_order,
+                'estimated_cost': product.qty_to_order * product.standard_price,
+                'alert_level': product.alert_level,
+                'stock_status': product.stock_status,
+            })
         
-        return sorted(suggestions, key=lambda x: x['alert_level'], reverse=True)
+        return suggestions
 
     @api.model
-    def get_stock_summary(self):
-        """Resumen general del estado de inventarios"""
-        all_products = self.search([])
-        
-        total_products = len(all_products)
-        critical = len([p for p in all_products if p.alert_level >= 4])
-        low = len([p for p in all_products if p.alert_level == 3])
-        reorder = len([p for p in all_products if p.alert_level == 2])
-        overstock = len([p for p in all_products if p.stock_status == 'overstock'])
-        optimal = len([p for p in all_products if p.stock_status == 'optimal'])
-        
-        total_value = sum(p.stock_value for p in all_products)
+    def _get_reorder_candidates(self, company):
+        """
+        Productos a reordenar del más al menos urgente
+
+        Una sola consulta sobre la vista: nivel de alerta descendente y, en
+        el mismo nivel, menos días de stock primero. Cada fila trae el
+        proveedor principal vigente para la compañía y si el producto ya
+        está en una solicitud de cotización abierta.
+
+        :param company: compañía de las órdenes de compra
+        :return: lista de tuplas (product_id, alert_level, qty_to_order,
+                 unidad de stock, partner_id del proveedor o None, cantidad
+                 mínima del proveedor, unidad de compra, True si ya hay una
+                 RFQ abierta); qty_to_order está en la unidad de stock y la
+                 cantidad mínima en la unidad de compra
+        """
+        cr = self.env.cr
+        self.env['purchase.order.line'].flush_model(['product_id', 'order_id'])
+        self.env['purchase.order'].flush_model(['state', 'company_id'])
+        cr.execute(SQL("""
+            SELECT r.product_id, r.alert_level, r.qty_to_order, pt.uom_id, vendor.partner_id,
+                   COALESCE(vendor.min_qty, 0), pt.uom_po_id,
+                   EXISTS (
+                       SELECT 1
+                       FROM purchase_order_line pol
+                       INNER JOIN purchase_order po ON po.id = pol.order_id
+                       WHERE pol.product_id = r.product_id
+                         AND po.state IN ('draft', 'sent', 'to approve')
+                         AND po.company_id = %(company_id)s
+                   ) AS has_open_rfq
+            FROM %(table)s r
+            INNER JOIN product_product pp ON pp.id = r.product_id
+            INNER JOIN product_template pt ON pt.id = pp.product_tmpl_id
+            LEFT JOIN LATERAL (
+                SELECT si.partner_id, si.min_qty
+                FROM product_supplierinfo si
+                WHERE si.product_tmpl_id = pt.id
+                  AND (si.product_id IS NULL OR si.product_id = pp.id)
+                  AND (si.company_id IS NULL OR si.company_id = %(company_id)s)
+                  AND (si.date_start IS NULL OR si.date_start <= CURRENT_DATE)
+                  AND (si.date_end IS NULL OR si.date_end >= CURRENT_DATE)
+                ORDER BY si.sequence, si.id
+                LIMIT 1
+            ) vendor ON TRUE
+            WHERE r.qty_to_order > 0
+              AND r.alert_level >= 2
+              AND pp.active
+              AND pt.purchase_ok
+            ORDER BY r.alert_level DESC, r.days_of_stock ASC, r.product_id
+        """, table=SQL.identifier(self._table), company_id=company.id))
+        return cr.fetchall()
+
+    @api.model
+    def _refresh_onhand(self, product_ids=None):
+        """
+        Recalcula las existencias en ubicaciones internas de los productos
+        indicados, o de todos
+
+        :param product_ids: ids de product.product; None para todo el catálogo
+        """
+        cr = self.env.cr
+        self.env['stock.quant'].flush_model(['product_id', 'location_id', 'quantity'])
+        if product_ids is None:
+            cr.execute(SQL("TRUNCATE %s", SQL.identifier(ONHAND_TABLE)))
+            cr.execute(SQL("""
+                INSERT INTO %s (product_id, qty_available)
+                SELECT q.product_id, SUM(q.quantity)
+                FROM stock_quant q
+                INNER JOIN stock_location l ON l.id = q.location_id
+                WHERE l.usage = 'internal'
+                GROUP BY q.product_id
+            """, SQL.identifier(ONHAND_TABLE)))
+            return
         
-        return {
-            'total_products': total_products,
-            'critical': critical,
-            'low': low,
-            'reorder': reorder,
-            'overstock': overstock,
-            'optimal': optimal,
-            'total_inventory_value': total_value,
-        }
+        if not product_ids:
+            return
+        cr.execute(SQL("""
+            INSERT INTO %s (product_id, qty_available)
+            SELECT p.product_id, COALESCE(SUM(q.quantity), 0)
+            FROM unnest(%s::int[]) AS p(product_id)
+            LEFT JOIN stock_quant q ON q.product_id = p.product_id
+                AND q.location_id IN (SELECT id FROM stock_location WHERE usage = 'internal')
+            GROUP BY p.product_id
+            ON CONFLICT (product_id) DO UPDATE SET qty_available = EXCLUDED.qty_available
+        """, SQL.identifier(ONHAND_TABLE), list(product_ids)))
+
+    @api.model
+    def _cron_refresh_onhand(self):
+        """Reconstruye las existencias completas (cubre cambios de quants sin movimientos)"""
+        self._refresh_onhand()
+        self._bump_version()
+
+    @api.model
+    def _on_stock_moves_done(self, product_ids):
+        """Actualiza las existencias de los productos movidos y descarta el resumen cacheado"""
+        self._refresh_onhand(product_ids)
+        self._bump_version()
+
+    @api.model
+    def _bump_version(self):
+        """
+        Descarta los resúmenes cacheados en todos los workers (sin bloquear filas)
+
+        nextval() no es transaccional: se ejecuta después del commit, con otro
+        cursor, para que la nueva versión no sea visible antes que los datos.
+        """
+        postcommit = self.env.cr.postcommit
+        if postcommit.data.get(VERSION_SEQUENCE):
+            return  # Ya programado en esta transacción
+        postcommit.data[VERSION_SEQUENCE] = True
+        registry = self.env.registry
+
+        @postcommit.add
+        def bump_version():
+            with registry.cursor() as cr:
+                cr.execute("SELECT nextval(%s)", [VERSION_SEQUENCE])
+
+    @api.model
+    def get_stock_summary(self):
+        """
+        Resumen general del estado de inventarios
+
+        Una sola consulta con FILTER; el resultado se reutiliza durante
+        STOCK_SUMMARY_TTL segundos o hasta que se valide un movimiento de stock.
+        """
+        self.env.cr.execute(SQL("SELECT last_value FROM %s", SQL.identifier(VERSION_SEQUENCE)))
+        key = (self.env.cr.dbname, self.env.cr.fetchone()[0])
+        summary = stock_summary_cache.get(key)
+        if summary is not None:
+            return dict(summary)
+
+        self.env.cr.execute(SQL("""
+            SELECT
+                COUNT(*) AS total_products,
+                COUNT(*) FILTER (WHERE alert_level >= 4) AS critical,
+                COUNT(*) FILTER (WHERE alert_level = 3) AS low,
+                COUNT(*) FILTER (WHERE alert_level = 2) AS reorder,
+                COUNT(*) FILTER (WHERE stock_status = 'overstock') AS overstock,
+                COUNT(*) FILTER (WHERE stock_status = 'optimal') AS optimal,
+                COALESCE(SUM(stock_value), 0)::float AS total_inventory_value
+            FROM %s
+        """, SQL.identifier(self._table)))
+        summary = self.env.cr.dictfetchone()
+        stock_summary_cache.set(key, dict(summary))
+        return summary
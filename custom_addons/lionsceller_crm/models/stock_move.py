@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+from odoo import models
+
+
+class StockMove(models.Model):
+    _inherit = 'stock.move'
+
+    def _action_done(self, cancel_backorder=False):
+        moves = super()._action_done(cancel_backorder=cancel_backorder)
+        # El stock cambió: actualizar existencias del reporte mín/máx y su resumen
+        self.env['stock.minmax.report'].sudo()._on_stock_moves_done(moves.product_id.ids)
+        return moves
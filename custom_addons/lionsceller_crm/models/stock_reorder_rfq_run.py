@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from odoo import api, fields, models, _
+
+_logger = logging.getLogger(__name__)
+
+
+class StockReorderRfqRun(models.Model):
+    """Corridas de generación automática de solicitudes de cotización
+
+    Un cron toma las sugerencias de reorden del reporte de inventarios
+    mín/máx por nivel de alerta, las agrupa por proveedor principal y crea
+    una RFQ en borrador por proveedor con create(vals_list) por bloques,
+    confirmando tras cada bloque. Cada corrida guarda sus tiempos y conteos.
+    Los productos que ya están en una RFQ abierta se omiten, así una corrida
+    interrumpida se completa en la siguiente sin duplicar líneas.
+    """
+    _name = 'stock.reorder.rfq.run'
+    _description = 'Generación Automática de Solicitudes de Cotización'
+    _order = 'id desc'
+    _rec_name = 'started_at'
+
+    state = fields.Selection([
+        ('running', 'En Proceso'),
+        ('done', 'Terminado'),
+        ('partial', 'Parcial'),
+        ('error', 'Error'),
+    ], string='Estado', default='running', required=True, readonly=True)
+    company_id = fields.Many2one('res.company', string='Compañía', required=True, readonly=True,
+                                 default=lambda self: self.env.company)
+    started_at = fields.Datetime(string='Iniciado el', readonly=True)
+    finished_at = fields.Datetime(string='Terminado el', readonly=True)
+    candidate_count = fields.Integer(string='Sugerencias', readonly=True)
+    open_rfq_count = fields.Integer(string='Ya en RFQ Abierta', readonly=True)
+    no_vendor_count = fields.Integer(string='Sin Proveedor', readonly=True)
+    vendor_count = fields.Integer(string='Proveedores', readonly=True)
+    order_count = fields.Integer(string='RFQs Creadas', readonly=True)
+    line_count = fields.Integer(string='Líneas Creadas', readonly=True)
+    query_seconds = fields.Float(string='Lectura (s)', digits=(16, 2), readonly=True)
+    create_seconds = fields.Float(string='Creación (s)', digits=(16, 2), readonly=True)
+    total_seconds = fields.Float(string='Duración (s)', digits=(16, 2), readonly=True)
+    purchase_order_ids = fields.Many2many(
+        'purchase.order', 'stock_reorder_rfq_run_order_rel', 'run_id', 'order_id',
+        string='Solicitudes de Cotización', readonly=True)
+    last_error = fields.Text(string='Último Error', readonly=True)
+
+    def action_generate_rfqs(self):
+        """Ejecuta el cron de generación en segundo plano"""
+        self.env.ref('lionsceller_crm.ir_cron_stock_reorder_rfq').sudo()._trigger()
+
+    def action_view_purchase_orders(self):
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _('Solicitudes de Cotización'),
+            'res_model': 'purchase.order',
+            'view_mode': 'list,form',
+            'domain': [('id', 'in', self.purchase_order_ids.ids)],
+        }
+
+    @api.model
+    def _cron_generate_rfqs(self, orders_per_batch=200, time_limit=600):
+        """
+        Crea las RFQs de las sugerencias de reorden
+
+        :param orders_per_batch: RFQs (proveedores) creadas por cada create(vals_list)
+        :param time_limit: segundos de la corrida; si se agotan, la corrida
+                           queda parcial y el cron se vuelve a disparar
+        """
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        start = time.monotonic()
+        run = self.create({'started_at': fields.Datetime.now()})
+        if auto_commit:
+            self.env.cr.commit()
+
+        try:
+            with self.env.cr.savepoint():
+                lines_by_vendor, severity_by_vendor = run._collect_candidates()
+            run.query_seconds = time.monotonic() - start
+
+            # Proveedores con los productos más urgentes primero
+            vendor_ids = sorted(lines_by_vendor, key=lambda vendor_id: severity_by_vendor[vendor_id], reverse=True)
+            run.vendor_count = len(vendor_ids)
+            create_start = time.monotonic()
+            for i in range(0, len(vendor_ids), orders_per_batch):
+                if time.monotonic() - start > time_limit:
+                    run.state = 'partial'
+                    break
+                with self.env.cr.savepoint():
+                    run._create_orders({
+                        vendor_id: lines_by_vendor[vendor_id]
+                        for vendor_id in vendor_ids[i:i + orders_per_batch]
+                    })
+                run.create_seconds = time.monotonic() - create_start
+                if auto_commit:
+                    self.env.cr.commit()
+        except Exception as e:
+            # Los bloques anteriores ya quedaron confirmados
+            _logger.exception("RFQs de reorden: error en la corrida %s", run.id)
+            run.write({'state': 'error', 'last_error': str(e)})
+
+        run.write({
+            'state': 'done' if run.state == 'running' else run.state,
+            'finished_at': fields.Datetime.now(),
+            'total_seconds': time.monotonic() - start,
+        })
+        _logger.info(
+            "RFQs de reorden: %s sugerencias, %s RFQs y %s líneas en %.1f s "
+            "(lectura %.1f s, creación %.1f s; %s sin proveedor, %s ya en RFQ abierta)",
+            run.candidate_count, run.order_count, run.line_count, run.total_seconds,
+            run.query_seconds, run.create_seconds, run.no_vendor_count, run.open_rfq_count)
+        if run.state == 'partial':
+            # Quedan proveedores: continuar en cuanto termine esta corrida
+            self.env.ref('lionsceller_crm.ir_cron_stock_reorder_rfq')._trigger()
+        return run
+
+    def _collect_candidates(self):
+        """
+        Agrupa las sugerencias de reorden por proveedor
+
+        Las cantidades quedan en la unidad de stock del producto; la cantidad
+        mínima del proveedor se convierte desde la unidad de compra.
+        :return: (líneas por proveedor [(product_id, cantidad, uom_id)], nivel
+                 de alerta más alto por proveedor)
+        """
+        self.ensure_one()
+        lines_by_vendor = defaultdict(list)
+        severity_by_vendor = {}
+        candidates = open_rfq = no_vendor = 0
+        Uom = self.env['uom.uom']
+        for product_id, alert_level, qty_to_order, uom_id, vendor_id, min_qty, po_uom_id, has_open_rfq in \
+                self.env['stock.minmax.report']._get_reorder_candidates(self.company_id):
+            candidates += 1
+            if has_open_rfq:
+                open_rfq += 1
+            elif not vendor_id:
+                no_vendor += 1
+            else:
+                qty = float(qty_to_order)
+                if min_qty:
+                    min_qty = float(min_qty)
+                    if po_uom_id != uom_id:
+                        min_qty = Uom.browse(po_uom_id)._compute_quantity(min_qty, Uom.browse(uom_id))
+                    qty = max(qty, min_qty)
+                lines_by_vendor[vendor_id].append((product_id, qty, uom_id))
+                severity_by_vendor.setdefault(vendor_id, alert_level)
+        self.write({
+            'candidate_count': candidates,
+            'open_rfq_count': open_rfq,
+            'no_vendor_count': no_vendor,
+        })
+        return lines_by_vendor, severity_by_vendor
+
+    def _create_orders(self, lines_by_vendor):
+        """Crea una RFQ en borrador por proveedor en un solo create"""
+        self.ensure_one()
+        origin = _("Reorden automático")
+        orders = self.env['purchase.order'].with_company(self.company_id).create([
+            {
+                'partner_id': vendor_id,
+                'company_id': self.company_id.id,
+                'origin': origin,
+                'order_line': [
+                    fields.Command.create({'product_id': product_id, 'product_qty': qty, 'product_uom': uom_id})
+                    for product_id, qty, uom_id in lines
+                ],
+            }
+            for vendor_id, lines in lines_by_vendor.items()
+        ])
+        self.write({
+            'purchase_order_ids': [fields.Command.link(order.id) for order in orders],
+            'order_count': self.order_count + len(orders),
+            'line_count': self.line_count + sum(len(lines) for lines in lines_by_vendor.values()),
+        })
+        return orders
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from odoo import api, fields, models, _
+from odoo.exceptions import ValidationError
+
+# Valores usados cuando ningún parámetro aplica al producto
+DEFAULT_LEAD_TIME_DAYS = 7.0
+DEFAULT_SERVICE_LEVEL = 95.0
+DEFAULT_REVIEW_PERIOD_DAYS = 30.0
+
+
+class StockReplenishmentParam(models.Model):
+    """Parámetros de reabastecimiento para el cálculo del stock de seguridad
+
+    Cada fila aplica a un producto, a una categoría (y sus subcategorías) o
+    a los productos de un proveedor; sin ninguno de ellos es el valor
+    general. Prioridad: producto, proveedor, categoría más cercana, general.
+    """
+    _name = 'stock.replenishment.param'
+    _description = 'Parámetros de Reabastecimiento'
+    _order = 'product_id, partner_id, categ_id, id'
+
+    product_id = fields.Many2one('product.product', string='Producto', ondelete='cascade', index='btree_not_null')
+    categ_id = fields.Many2one('product.category', string='Categoría', ondelete='cascade', index='btree_not_null')
+    partner_id = fields.Many2one('res.partner', string='Proveedor', ondelete='cascade', index='btree_not_null')
+    lead_time_days = fields.Float(string='Tiempo de Reabastecimiento (días)', default=DEFAULT_LEAD_TIME_DAYS,
+                                  required=True)
+    service_level = fields.Float(string='Nivel de Servicio (%)', default=DEFAULT_SERVICE_LEVEL, required=True,
+                                 help='Probabilidad objetivo de no quedarse sin stock durante el reabastecimiento')
+    review_period_days = fields.Float(string='Periodo de Revisión (días)', default=DEFAULT_REVIEW_PERIOD_DAYS,
+                                      required=True, help='Cada cuántos días se revisa y se ordena el producto')
+
+    _sql_constraints = [
+        ('single_scope', 'CHECK(num_nonnulls(product_id, categ_id, partner_id) <= 1)',
+         'Un parámetro aplica a un producto, a una categoría o a un proveedor, no a varios.'),
+    ]
+
+    @api.constrains('lead_time_days', 'service_level', 'review_period_days')
+    def _check_values(self):
+        for param in self:
+            if param.lead_time_days < 0 or param.review_period_days < 0:
+                raise ValidationError(_("Los días de reabastecimiento y de revisión no pueden ser negativos."))
+            if not 50 <= param.service_level < 100:
+                raise ValidationError(_("El nivel de servicio debe estar entre 50% y 99.99%."))
+
+    @api.depends('product_id', 'categ_id', 'partner_id')
+    def _compute_display_name(self):
+        for param in self:
+            scope = param.product_id or param.partner_id or param.categ_id
+            param.display_name = scope.display_name if scope else _("General")
+
+    @api.model
+    def _get_param_index(self):
+        """
+        Todos los parámetros en diccionarios por alcance
+
+        :return: (por producto, por proveedor, por categoría, general); cada
+                 valor es una tupla (lead_time_days, service_level, review_period_days)
+        """
+        by_product, by_vendor, by_categ = {}, {}, {}
+        default = (DEFAULT_LEAD_TIME_DAYS, DEFAULT_SERVICE_LEVEL, DEFAULT_REVIEW_PERIOD_DAYS)
+        for param in self.sudo().search([]):
+            values = (param.lead_time_days, param.service_level, param.review_period_days)
+            if param.product_id:
+                by_product[param.product_id.id] = values
+            elif param.partner_id:
+                by_vendor[param.partner_id.id] = values
+            elif param.categ_id:
+                by_categ[param.categ_id.id] = values
+            else:
+                default = values
+        return by_product, by_vendor, by_categ, default
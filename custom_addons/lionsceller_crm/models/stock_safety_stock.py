@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import logging
+from statistics import NormalDist
+
+import numpy as np
+
+from odoo import api, fields, models
+from odoo.tools import SQL
+
+from .product_trend_report import DEMAND_TABLE
+
+_logger = logging.getLogger(__name__)
+
+# Días de demanda usados para la media y la variabilidad
+DEMAND_WINDOW_DAYS = 90
+# Niveles fijos para productos sin demanda en la ventana
+NO_DEMAND_LEVELS = (10.0, 15.0, 30.0)  # mínimo, punto de reorden, máximo
+
+
+class StockSafetyStock(models.Model):
+    """Stock de seguridad y niveles mín/máx calculados por producto
+
+    Un cron calcula todo el catálogo a la vez con NumPy a partir de la
+    demanda diaria y de los parámetros de reabastecimiento:
+    SS = z · σ · √(L + R), punto de reorden = μ · L + SS,
+    máximo = μ · (L + R) + SS y mínimo = SS. El reporte de inventarios
+    mín/máx lee estos valores.
+    """
+    _name = 'stock.safety.stock'
+    _description = 'Stock de Seguridad por Producto'
+    _log_access = False
+    _order = 'product_id'
+    _rec_name = 'product_id'
+
+    product_id = fields.Many2one('product.product', string='Producto', required=True,
+                                 ondelete='cascade', readonly=True)
+    lead_time_days = fields.Float(string='Tiempo de Reabastecimiento (días)', readonly=True)
+    review_period_days = fields.Float(string='Periodo de Revisión (días)', readonly=True)
+    service_level = fields.Float(string='Nivel de Servicio (%)', readonly=True)
+    avg_daily_demand = fields.Float(string='Demanda Diaria Promedio', digits=(16, 2), readonly=True)
+    demand_std = fields.Float(string='Desviación de la Demanda', digits=(16, 2), readonly=True)
+    safety_stock = fields.Float(string='Stock de Seguridad', digits=(16, 2), readonly=True)
+    min_stock = fields.Float(string='Stock Mínimo', digits=(16, 2), readonly=True)
+    reorder_point = fields.Float(string='Punto de Reorden', digits=(16, 2), readonly=True)
+    max_stock = fields.Float(string='Stock Máximo', digits=(16, 2), readonly=True)
+    computed_at = fields.Datetime(string='Calculado el', readonly=True)
+
+    _sql_constraints = [
+        ('product_unique', 'UNIQUE(product_id)', 'Solo puede existir un cálculo por producto.'),
+    ]
+
+    @api.model
+    def _get_products(self):
+        """
+        Productos del reporte con su categoría y proveedor principal
+
+        :return: lista de tuplas (product_id, parent_path de la categoría, partner_id del proveedor)
+        """
+        self.env.cr.execute("""
+            SELECT pp.id, pc.parent_path, vendor.partner_id
+            FROM product_product pp
+            INNER JOIN product_template pt ON pp.product_tmpl_id = pt.id
+            LEFT JOIN product_category pc ON pc.id = pt.categ_id
+            LEFT JOIN LATERAL (
+                SELECT si.partner_id
+                FROM product_supplierinfo si
+                WHERE si.product_tmpl_id = pt.id
+                  AND (si.product_id IS NULL OR si.product_id = pp.id)
+                ORDER BY si.sequence, si.id
+                LIMIT 1
+            ) vendor ON TRUE
+            WHERE pp.active AND pt.active AND pt.type IN ('product', 'consu')
+            ORDER BY pp.id
+        """)
+        return self.env.cr.fetchall()
+
+    @api.model
+    def _cron_compute_safety_stock(self):
+        """Recalcula el stock de seguridad de todo el catálogo en un solo lote"""
+        products = self._get_products()
+        self.env.cr.execute(SQL("DELETE FROM %s", SQL.identifier(self._table)))
+        if not products:
+            return
+
+        # Parámetros de cada producto: producto > proveedor > categoría más cercana > general
+        by_product, by_vendor, by_categ, default = self.env['stock.replenishment.param']._get_param_index()
+        params = []
+        for product_id, parent_path, vendor_id in products:
+            values = by_product.get(product_id) or by_vendor.get(vendor_id)
+            if not values and parent_path:
+                categ_ids = [int(categ_id) for categ_id in parent_path.split('/') if categ_id]
+                values = next((by_categ[categ_id] for categ_id in reversed(categ_ids) if categ_id in by_categ), None)
+            params.append(values or default)
+        lead_time, service_level, review_period = (np.array(column, dtype=float) for column in zip(*params))
+
+        # Demanda diaria de la ventana: filas = productos, columnas = días (0 = hoy)
+        product_ids = [product[0] for product in products]
+        row_index = {product_id: i for i, product_id in enumerate(product_ids)}
+        self.env.cr.execute(SQL("""
+            SELECT product_id, CURRENT_DATE - day AS age, qty
+            FROM %s
+            WHERE day > CURRENT_DATE - %s AND day <= CURRENT_DATE
+        """, SQL.identifier(DEMAND_TABLE), DEMAND_WINDOW_DAYS))
+        demand = np.zeros((len(product_ids), DEMAND_WINDOW_DAYS))
+        rows, ages, quantities = [], [], []
+        for product_id, age, qty in self.env.cr.fetchall():
+            if product_id in row_index:
+                rows.append(row_index[product_id])
+                ages.append(age)
+                quantities.append(float(qty))
+        np.add.at(demand, (np.array(rows, dtype=int), np.array(ages, dtype=int)), np.array(quantities))
+
+        mean = demand.mean(axis=1)
+        std = demand.std(axis=1, ddof=1)
+        z_by_level = {level: NormalDist().inv_cdf(level / 100.0) for level in set(service_level.tolist())}
+        z = np.array([z_by_level[level] for level in service_level.tolist()])
+
+        safety_stock = np.maximum(z * std * np.sqrt(lead_time + review_period), 0.0)
+        has_demand = mean > 0
+        min_stock = np.where(has_demand, safety_stock, NO_DEMAND_LEVELS[0])
+        reorder_point = np.where(has_demand, mean * lead_time + safety_stock, NO_DEMAND_LEVELS[1])
+        max_stock = np.where(has_demand, mean * (lead_time + review_period) + safety_stock, NO_DEMAND_LEVELS[2])
+
+        self.env.cr.execute(SQL("""
+            INSERT INTO %s (
+                product_id, lead_time_days, review_period_days, service_level,
+                avg_daily_demand, demand_std, safety_stock, min_stock, reorder_point, max_stock, computed_at
+            )
+            SELECT UNNEST(%s::int[]), UNNEST(%s::float[]), UNNEST(%s::float[]), UNNEST(%s::float[]),
+                   UNNEST(%s::float[]), UNNEST(%s::float[]), UNNEST(%s::float[]), UNNEST(%s::float[]),
+                   UNNEST(%s::float[]), UNNEST(%s::float[]), NOW() AT TIME ZONE 'UTC'
+        """,
+            SQL.identifier(self._table),
+            product_ids,
+            lead_time.tolist(),
+            review_period.tolist(),
+            service_level.tolist(),
+            mean.tolist(),
+            std.tolist(),
+            safety_stock.tolist(),
+            min_stock.tolist(),
+            reorder_point.tolist(),
+            max_stock.tolist(),
+        ))
+        self.invalidate_model()
+        self.env['stock.minmax.report']._bump_version()
+        _logger.info("Stock de seguridad: %s productos calculados", len(product_ids))
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from odoo import api, fields, models, tools, _
+from odoo.exceptions import UserError, ValidationError
+from odoo.tools.safe_eval import safe_eval
+
+from . import whatsapp_sender
+from .whatsapp_helper import normalize_phone
+
+_logger = logging.getLogger(__name__)
+
+# Segundos máximos de envío por ejecución del cron (luego se vuelve a disparar)
+CRON_TIME_BUDGET = 240
+# Destinatarios reservados y enviados por bloque
+CHUNK_SIZE = 500
+
+DEFAULT_TEMPLATE = (
+    "Hola {cliente},\n\n"
+    "Te recordamos que tienes una oportunidad pendiente: {oportunidad}\n\n"
+    "¿En qué podemos ayudarte?\n\n"
+    "Saludos,\n{asesor}"
+)
+
+
+class _TemplateValues(dict):
+    """Deja intactos los marcadores desconocidos al renderizar la plantilla"""
+
+    def __missing__(self, key):
+        return '{%s}' % key
+
+
+def render_template(template, values):
+    return template.format_map(_TemplateValues(values))
+
+
+class WhatsAppCampaign(models.Model):
+    """Campaña de WhatsApp: envía un mensaje a todos los leads de un dominio"""
+    _name = 'whatsapp.campaign'
+    _description = 'Campaña de WhatsApp'
+    _order = 'id desc'
+
+    name = fields.Char(string='Nombre', required=True)
+    lead_domain = fields.Char(string='Leads', default='[]', required=True,
+                              help='Dominio de las oportunidades que recibirán el mensaje')
+    message_template = fields.Text(
+        string='Plantilla del Mensaje', required=True, default=DEFAULT_TEMPLATE,
+        help='Marcadores disponibles: {cliente}, {oportunidad}, {asesor}, {empresa}')
+    max_workers = fields.Integer(string='Envíos en Paralelo', default=8,
+                                 help='Hilos que envían a la vez (el límite por segundo lo pone el nivel de throughput)')
+    state = fields.Selection([
+        ('draft', 'Borrador'),
+        ('running', 'Enviando'),
+        ('done', 'Terminada'),
+        ('cancel', 'Cancelada'),
+    ], string='Estado', default='draft', required=True, readonly=True, index=True)
+    started_at = fields.Datetime(string='Inicio', readonly=True)
+    finished_at = fields.Datetime(string='Fin', readonly=True)
+    recipient_ids = fields.One2many('whatsapp.campaign.recipient', 'campaign_id', string='Destinatarios')
+
+    # Progreso (una sola consulta agrupada para todas las campañas)
+    total_count = fields.Integer(string='Destinatarios', compute='_compute_progress')
+    sent_count = fields.Integer(string='Enviados', compute='_compute_progress')
+    failed_count = fields.Integer(string='Fallidos', compute='_compute_progress')
+    skipped_count = fields.Integer(string='Sin Teléfono', compute='_compute_progress')
+    simulated_count = fields.Integer(string='Simulados (Modo Prueba)', compute='_compute_progress')
+    pending_count = fields.Integer(string='Pendientes', compute='_compute_progress')
+    progress = fields.Float(string='Progreso (%)', compute='_compute_progress')
+    throughput = fields.Float(string='Mensajes/seg', compute='_compute_progress', digits=(16, 1))
+
+    # Entregas y lecturas (desde whatsapp.message.status)
+    delivered_count = fields.Integer(string='Entregados', compute='_compute_delivery')
+    read_count = fields.Integer(string='Leídos', compute='_compute_delivery')
+    delivery_rate = fields.Float(string='Tasa de Entrega (%)', compute='_compute_delivery', digits=(16, 1))
+    read_rate = fields.Float(string='Tasa de Lectura (%)', compute='_compute_delivery', digits=(16, 1))
+
+    @api.constrains('message_template')
+    def _check_message_template(self):
+        for campaign in self:
+            try:
+                render_template(campaign.message_template, {})
+            except (ValueError, IndexError) as e:
+                raise ValidationError(_('La plantilla del mensaje no es válida: %s') % e)
+
+    @api.constrains('max_workers')
+    def _check_max_workers(self):
+        for campaign in self:
+            if not 1 <= campaign.max_workers <= 32:
+                raise ValidationError(_('Los envíos en paralelo deben estar entre 1 y 32.'))
+
+    @api.depends('state')
+    def _compute_progress(self):
+        counts = {}
+        if self.ids:
+            groups = self.env['whatsapp.campaign.recipient']._read_group(
+                [('campaign_id', 'in', self.ids)], ['campaign_id', 'state'], ['__count'])
+            for campaign, state, count in groups:
+                counts[campaign.id, state] = count
+        now = fields.Datetime.now()
+        for campaign in self:
+            sent = counts.get((campaign.id, 'sent'), 0)
+            failed = counts.get((campaign.id, 'failed'), 0)
+            skipped = counts.get((campaign.id, 'skipped'), 0)
+            simulated = counts.get((campaign.id, 'simulated'), 0)
+            pending = counts.get((campaign.id, 'pending'), 0)
+            total = sent + failed + skipped + simulated + pending
+            campaign.sent_count = sent
+            campaign.failed_count = failed
+            campaign.skipped_count = skipped
+            campaign.simulated_count = simulated
+            campaign.pending_count = pending
+            campaign.total_count = total
+            campaign.progress = 100.0 * (total - pending) / total if total else 0.0
+            elapsed = campaign.started_at and ((campaign.finished_at or now) - campaign.started_at).total_seconds()
+            campaign.throughput = (sent + failed) / elapsed if elapsed else 0.0
+
+    def _compute_delivery(self):
+        rates = {}
+        if self.ids:
+            rates = {
+                row['campaign_id']: row
+                for row in self.env['whatsapp.message.status'].get_delivery_rates(
+                    'campaign_id', [('campaign_id', 'in', self.ids)])
+            }
+        for campaign in self:
+            row = rates.get(campaign.id, {})
+            campaign.delivered_count = row.get('delivered', 0)
+            campaign.read_count = row.get('read', 0)
+            campaign.delivery_rate = row.get('delivery_rate', 0.0)
+            campaign.read_rate = row.get('read_rate', 0.0)
+
+    def action_start(self):
+        """Renderiza todos los mensajes de una vez y pone la campaña en cola de envío"""
+        config = self.env['whatsapp.helper']._get_config()
+        if not config.test_mode and not config.can_send:
+            raise UserError(_('Configure el token de acceso y el ID del número de WhatsApp, '
+                              'o active el modo de prueba, antes de iniciar una campaña.'))
+        for campaign in self:
+            if campaign.state != 'draft':
+                raise UserError(_('Solo se pueden iniciar campañas en borrador.'))
+            campaign._prepare_recipients()
+        self.write({'state': 'running', 'started_at': fields.Datetime.now()})
+        cron = self.env.ref('lionsceller_crm.ir_cron_whatsapp_campaign', raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+
+    def action_cancel(self):
+        self.filtered(lambda c: c.state in ('draft', 'running')).write({
+            'state': 'cancel',
+            'finished_at': fields.Datetime.now(),
+        })
+
+    def _prepare_recipients(self):
+        """Crea un destinatario por lead con el mensaje ya renderizado"""
+        self.ensure_one()
+        leads = self.env['crm.lead'].search(safe_eval(self.lead_domain or '[]'))
+        company_name = self.env.company.name
+        vals_list = []
+        for lead in leads:
+            phone = lead.phone or lead.mobile or lead.partner_id.phone or lead.partner_id.mobile
+            phone_clean = normalize_phone(phone)
+            vals = {
+                'campaign_id': self.id,
+                'lead_id': lead.id,
+                'phone': phone_clean and phone_clean.lstrip('+'),
+                'state': 'pending' if phone_clean else 'skipped',
+            }
+            if phone_clean:
+                vals['message'] = render_template(self.message_template, {
+                    'cliente': lead.partner_id.name or lead.contact_name or 'Cliente',
+                    'oportunidad': lead.name,
+                    'asesor': lead.user_id.name or 'Equipo de Ventas',
+                    'empresa': company_name,
+                })
+            vals_list.append(vals)
+        # Los destinatarios son de solo lectura para los gerentes; la campaña ya pasó sus permisos
+        self.env['whatsapp.campaign.recipient'].sudo().create(vals_list)
+        _logger.info("Campaña %s: %s destinatarios preparados", self.name, len(vals_list))
+
+    @api.model
+    def _cron_run_campaigns(self):
+        """Envía las campañas en curso por bloques, dentro del tiempo asignado al cron"""
+        deadline = time.monotonic() + CRON_TIME_BUDGET
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        for campaign in self.search([('state', '=', 'running')], order='id'):
+            while time.monotonic() < deadline:
+                if not campaign._send_chunk(CHUNK_SIZE):
+                    campaign.write({'state': 'done', 'finished_at': fields.Datetime.now()})
+                    break
+                if auto_commit:
+                    self.env.cr.commit()
+                campaign.invalidate_recordset(['state'])
+                if campaign.state != 'running':
+                    break
+            else:
+                cron = self.env.ref('lionsceller_crm.ir_cron_whatsapp_campaign', raise_if_not_found=False)
+                if cron:
+                    cron._trigger()
+                break
+
+    def _send_chunk(self, limit):
+        """
+        Reserva un bloque de destinatarios pendientes y los envía en paralelo
+
+        Los hilos solo hacen HTTP (sin ORM); el limitador de whatsapp_sender
+        mantiene el total dentro del throughput del número.
+        :return: cantidad de destinatarios procesados
+        """
+        self.ensure_one()
+        self.env.cr.execute("""
+            SELECT id, phone, message
+            FROM whatsapp_campaign_recipient
+            WHERE campaign_id = %s AND state = 'pending'
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        """, [self.id, limit])
+        rows = self.env.cr.fetchall()
+        if not rows:
+            return 0
+
+        helper = self.env['whatsapp.helper']
+        config = helper._get_config()
+
+        simulated = config.test_mode
+        if simulated:
+            results = [whatsapp_sender.SendResult(True, {}, '', False)] * len(rows)
+        elif not config.can_send:
+            # Credenciales borradas con la campaña en curso
+            error = _('Faltan las credenciales de WhatsApp')
+            results = [whatsapp_sender.SendResult(False, {}, error, False)] * len(rows)
+        else:
+            def send(row):
+                return whatsapp_sender.post_message(
+                    config.phone_number_id,
+                    config.access_token,
+                    helper._build_text_payload(row[1], row[2]),
+                    api_url=config.api_url,
+                    rate=config.messages_per_second,
+                )
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = list(executor.map(send, rows))
+
+        self.env['whatsapp.campaign.recipient']._write_results(
+            [row[0] for row in rows], results, simulated=simulated)
+        return len(rows)
+
+
+class WhatsAppCampaignRecipient(models.Model):
+    """Estado de envío por destinatario de una campaña"""
+    _name = 'whatsapp.campaign.recipient'
+    _description = 'Destinatario de Campaña de WhatsApp'
+    _log_access = False
+    _order = 'id'
+
+    campaign_id = fields.Many2one('whatsapp.campaign', string='Campaña', required=True,
+                                  ondelete='cascade', readonly=True)
+    lead_id = fields.Many2one('crm.lead', string='Lead/Oportunidad', ondelete='set null', readonly=True)
+    phone = fields.Char(string='Teléfono', readonly=True)
+    message = fields.Text(string='Mensaje', readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pendiente'),
+        ('sent', 'Enviado'),
+        ('failed', 'Fallido'),
+        ('skipped', 'Sin Teléfono'),
+        ('simulated', 'Simulado (Modo Prueba)'),
+    ], string='Estado', default='pending', required=True, readonly=True)
+    sent_at = fields.Datetime(string='Enviado el', readonly=True)
+    wamid = fields.Char(string='ID de Mensaje', readonly=True)
+    error = fields.Char(string='Error', readonly=True)
+
+    def init(self):
+        tools.create_index(self.env.cr, 'whatsapp_campaign_recipient_campaign_state_idx',
+                           self._table, ['campaign_id', 'state'])
+
+    @api.model
+    def _write_results(self, recipient_ids, results, simulated=False):
+        """
+        Guarda el resultado de un bloque de envíos con un solo UPDATE
+
+        :param simulated: envíos del modo de prueba; quedan como 'simulated'
+                          y no se registran para el seguimiento de entregas
+        """
+        sent_state = 'simulated' if simulated else 'sent'
+        sent_error = _('[MODO PRUEBA] Envío simulado, no se envió el mensaje') if simulated else None
+        self.env.cr.execute("""
+            UPDATE whatsapp_campaign_recipient r
+            SET state = v.state,
+                wamid = v.wamid,
+                error = v.error,
+                sent_at = NOW() AT TIME ZONE 'UTC'
+            FROM (
+                SELECT UNNEST(%s::int[]) AS id,
+                       UNNEST(%s::varchar[]) AS state,
+                       UNNEST(%s::varchar[]) AS wamid,
+                       UNNEST(%s::varchar[]) AS error
+            ) v
+            WHERE r.id = v.id
+        """, [
+            recipient_ids,
+            [sent_state if result.success else 'failed' for result in results],
+            [whatsapp_sender.message_id(result.response) if result.success else None for result in results],
+            [sent_error if result.success else (result.error or '')[:255] for result in results],
+        ])
+        self.invalidate_model(['state', 'wamid', 'error', 'sent_at'])
+
+        # Registrar los enviados para el seguimiento de entregas y lecturas
+        self.env.cr.execute("""
+            SELECT r.wamid, r.lead_id, r.campaign_id, l.user_id
+            FROM whatsapp_campaign_recipient r
+            LEFT JOIN crm_lead l ON l.id = r.lead_id
+            WHERE r.id = ANY(%s) AND r.wamid IS NOT NULL
+        """, [recipient_ids])
+        self.env['whatsapp.message.status']._register_outbound(self.env.cr.dictfetchall())
@@ -1,18 +1,71 @@
 # -*- coding: utf-8 -*-
 import logging
-import requests
-import json
-from odoo import api, models, fields, _
-from odoo.exceptions import UserError
+from collections import namedtuple
+
+from odoo import api, models, fields, tools, _
+
+from . import whatsapp_sender
 
 _logger = logging.getLogger(__name__)
 
+# Código de país por defecto para números nacionales de 10 dígitos
+DEFAULT_COUNTRY_CODE = '52'
+
+
+class WhatsAppConfig(namedtuple('WhatsAppConfig', [
+    'access_token', 'phone_number_id', 'verify_token', 'test_mode', 'api_url', 'messages_per_second',
+    'log_sample_rate', 'log_payload_max', 'thread_window_hours',
+])):
+    """Configuración de WhatsApp (parámetros lionsceller_crm.whatsapp_*) ya tipada"""
+    __slots__ = ()
+
+    @property
+    def can_send(self):
+        """True si hay credenciales y no está activo el modo de prueba"""
+        return not self.test_mode and bool(self.access_token and self.phone_number_id)
+
+
+def normalize_phone(number):
+    """
+    Normaliza un número de teléfono a formato E.164 (ej: +525512345678)
+
+    Quita espacios, guiones y el prefijo internacional 00, agrega el código
+    de México a los números de 10 dígitos y elimina el "1" heredado con el
+    que WhatsApp envía los móviles mexicanos (521...).
+
+    :return: número normalizado o False si no parece un teléfono válido
+    """
+    if not number:
+        return False
+    digits = ''.join(filter(str.isdigit, number))
+    if number.strip().startswith('00'):
+        digits = digits[2:]
+    if not digits.startswith(DEFAULT_COUNTRY_CODE) and len(digits) == 10:
+        digits = DEFAULT_COUNTRY_CODE + digits
+    if digits.startswith(DEFAULT_COUNTRY_CODE + '1') and len(digits) == 13:
+        digits = DEFAULT_COUNTRY_CODE + digits[3:]
+    if not 8 <= len(digits) <= 15:
+        return False
+    return '+' + digits
+
 
 class WhatsAppHelper(models.AbstractModel):
     """Helper model para enviar mensajes de WhatsApp vía Meta Cloud API"""
     _name = 'whatsapp.helper'
     _description = 'WhatsApp Helper'
 
+    @api.model
+    def find_partner_by_phone(self, phone_number):
+        """
+        Busca el contacto cuyo teléfono o móvil coincide con el número
+
+        Usa las columnas normalizadas e indexadas de res.partner, por lo
+        que es una búsqueda exacta sin importar el formato del número.
+        """
+        Partner = self.env['res.partner'].sudo()
+        key = normalize_phone(phone_number)
+        return Partner._find_by_phone_e164([key]).get(key, Partner)
+
     def send_message(self, phone_number, message, partner_id=None, lead_id=None):
         """
         Envía un mensaje de WhatsApp usando Meta Cloud API
@@ -23,15 +76,10 @@ class WhatsAppHelper(models.AbstractModel):
         :param lead_id: ID del lead (opcional, para logging)
         :return: dict con resultado del envío
         """
-        ICP = self.env['ir.config_parameter'].sudo()
-        
-        # Obtener configuración
-        access_token = ICP.get_param('lionsceller_crm.whatsapp_access_token')
-        phone_number_id = ICP.get_param('lionsceller_crm.whatsapp_phone_number_id')
-        test_mode = ICP.get_param('lionsceller_crm.whatsapp_test_mode', 'False') == 'True'
+        config = self._get_config()
         
         # MODO DE PRUEBA: Simular envío sin configuración
-        if test_mode or not access_token or not phone_number_id:
+        if not config.can_send:
             _logger.warning("⚠️ MODO DE PRUEBA - WhatsApp no se enviará realmente")
             
             if lead_id:
@@ -48,22 +96,51 @@ class WhatsAppHelper(models.AbstractModel):
                 'test_mode': True
             }
         
-        # Limpiar número de teléfono (quitar espacios, guiones, etc)
-        phone_clean = ''.join(filter(str.isdigit, phone_number))
-        
-        # Si no tiene código de país, agregar el de México por defecto
-        if not phone_clean.startswith('52') and len(phone_clean) == 10:
-            phone_clean = '52' + phone_clean
+        # Normalizar número (sin espacios ni guiones, con código de país)
+        phone_clean = (normalize_phone(phone_number) or ''.join(filter(str.isdigit, phone_number))).lstrip('+')
         
-        # Preparar el payload para Meta Cloud API
-        url = f"https://graph.facebook.com/v18.0/{phone_number_id}/messages"
+        # El envío real se hace desde la bandeja de salida, fuera de esta transacción
+        outbox = self.env['whatsapp.outbox'].sudo().enqueue(
+            phone_clean, message, partner_id=partner_id, lead_id=lead_id
+        )
+        _logger.info(f"WhatsApp en cola para {phone_clean} (outbox {outbox.id}): {message[:50]}...")
         
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json',
+        return {
+            'success': True,
+            'message': 'Mensaje en cola de envío',
+            'queued': True,
+            'outbox_id': outbox.id,
         }
+
+    @api.model
+    @tools.ormcache()
+    def _get_config(self):
+        """
+        Snapshot de la configuración de WhatsApp, cacheado por registro
         
-        payload = {
+        Se invalida al guardar res.config.settings (y con cualquier
+        set_param), así los envíos y el webhook no leen ir_config_parameter.
+        """
+        ICP = self.env['ir.config_parameter'].sudo()
+        return WhatsAppConfig(
+            access_token=ICP.get_param('lionsceller_crm.whatsapp_access_token') or '',
+            phone_number_id=ICP.get_param('lionsceller_crm.whatsapp_phone_number_id') or '',
+            verify_token=ICP.get_param('lionsceller_crm.whatsapp_verify_token') or 'LIONSCELLER_SECRET_TOKEN',
+            test_mode=ICP.get_param('lionsceller_crm.whatsapp_test_mode', 'False') == 'True',
+            api_url=ICP.get_param('lionsceller_crm.whatsapp_api_url') or whatsapp_sender.DEFAULT_API_URL,
+            messages_per_second=int(ICP.get_param(
+                'lionsceller_crm.whatsapp_messages_per_second',
+                whatsapp_sender.DEFAULT_MESSAGES_PER_SECOND,
+            )),
+            log_sample_rate=float(ICP.get_param('lionsceller_crm.whatsapp_log_sample_rate', '0.01')),
+            log_payload_max=int(ICP.get_param('lionsceller_crm.whatsapp_log_payload_max', '512')),
+            thread_window_hours=int(ICP.get_param('lionsceller_crm.whatsapp_thread_window_hours', '72')),
+        )
+
+    @api.model
+    def _build_text_payload(self, phone_clean, message):
+        """Payload de mensaje de texto para Meta Cloud API"""
+        return {
             "messaging_product": "whatsapp",
             "recipient_type": "individual",
             "to": phone_clean,
@@ -73,47 +150,35 @@ class WhatsAppHelper(models.AbstractModel):
                 "body": message
             }
         }
+
+    @api.model
+    def _send_now(self, phone_clean, message):
+        """
+        Envía el mensaje de inmediato por HTTP (usado por la bandeja de salida)
         
-        _logger.info(f"Enviando WhatsApp a {phone_clean}: {message[:50]}...")
+        :return: dict con success, message, response, retryable
+        """
+        config = self._get_config()
+        result = whatsapp_sender.post_message(
+            config.phone_number_id,
+            config.access_token,
+            self._build_text_payload(phone_clean, message),
+            api_url=config.api_url,
+            rate=config.messages_per_second,
+        )
+        if result.success:
+            _logger.info(f"✅ WhatsApp enviado exitosamente: {result.response}")
+            return {
+                'success': True,
+                'message': 'Mensaje enviado exitosamente',
+                'response': result.response,
+                'retryable': False,
+            }
         
-        try:
-            response = requests.post(url, headers=headers, json=payload, timeout=10)
-            response_data = response.json()
-            
-            if response.status_code == 200:
-                _logger.info(f"✅ WhatsApp enviado exitosamente: {response_data}")
-                
-                # Registrar en el chatter si es un lead
-                if lead_id:
-                    lead = self.env['crm.lead'].browse(lead_id)
-                    lead.message_post(
-                        body=_("📱 Mensaje de WhatsApp enviado:<br/><i>%s</i>") % message,
-                        message_type='comment',
-                        subtype_xmlid='mail.mt_note'
-                    )
-                
-                return {
-                    'success': True,
-                    'message': 'Mensaje enviado exitosamente',
-                    'response': response_data
-                }
-            else:
-                error_msg = response_data.get('error', {}).get('message', 'Error desconocido')
-                _logger.error(f"❌ Error enviando WhatsApp: {response_data}")
-                
-                return {
-                    'success': False,
-                    'message': error_msg,
-                    'response': response_data
-                }
-                
-        except requests.exceptions.RequestException as e:
-            _logger.error(f"❌ Error de conexión al enviar WhatsApp: {str(e)}")
-            raise UserError(_(
-                'Error al conectar con WhatsApp API:\n%s'
-            ) % str(e))
-        except Exception as e:
-            _logger.error(f"❌ Error inesperado enviando WhatsApp: {str(e)}")
-            raise UserError(_(
-                'Error al enviar WhatsApp:\n%s'
-            ) % str(e))
+        _logger.error(f"❌ Error enviando WhatsApp: {result.error}")
+        return {
+            'success': False,
+            'message': result.error,
+            'response': result.response,
+            'retryable': result.retryable,
+        }
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import threading
+from datetime import timedelta
+
+from odoo import api, fields, models
+from odoo.tools import SQL
+
+from .whatsapp_helper import normalize_phone
+from .whatsapp_metrics import METRICS_TABLE, log_event, registry as metrics
+
+_logger = logging.getLogger(__name__)
+
+# Intentos antes de mover un payload a la cola de descartados
+MAX_ATTEMPTS = 5
+# Días que se conservan los payloads ya procesados
+DONE_RETENTION_DAYS = 7
+
+
+class WhatsAppInboundQueue(models.Model):
+    """Cola persistente de payloads recibidos en /whatsapp/webhook
+
+    El controlador solo inserta el payload crudo y responde 200; un cron
+    drena la cola en lotes, con reintentos y estado de descartado.
+    """
+    _name = 'whatsapp.inbound.queue'
+    _description = 'Cola de Mensajes Entrantes de WhatsApp'
+    _order = 'id desc'
+
+    payload = fields.Text(string='Payload', required=True, readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pendiente'),
+        ('error', 'Error (reintentando)'),
+        ('done', 'Procesado'),
+        ('dead', 'Descartado'),
+    ], string='Estado', default='pending', required=True, index=True, readonly=True)
+    attempts = fields.Integer(string='Intentos', default=0, readonly=True)
+    next_attempt_at = fields.Datetime(string='Próximo Intento', readonly=True)
+    processed_at = fields.Datetime(string='Procesado el', readonly=True)
+    last_error = fields.Text(string='Último Error', readonly=True)
+
+    def init(self):
+        # Totales de métricas de todos los procesos (ver whatsapp_metrics)
+        self.env.cr.execute(SQL("""
+            CREATE TABLE IF NOT EXISTS %s (
+                name varchar NOT NULL,
+                labels varchar NOT NULL,
+                value float8 NOT NULL DEFAULT 0,
+                sum float8 NOT NULL DEFAULT 0,
+                buckets float8[],
+                PRIMARY KEY (name, labels)
+            )
+        """, SQL.identifier(METRICS_TABLE)))
+
+    @api.model
+    def enqueue_payload(self, raw_payload):
+        """Guarda el payload crudo y despierta al cron que drena la cola"""
+        record = self.sudo().create({'payload': raw_payload})
+        cron = self.env.ref('lionsceller_crm.ir_cron_whatsapp_inbound_queue', raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+        return record
+
+    def action_retry(self):
+        """Vuelve a poner en cola los payloads con error o descartados"""
+        self.filtered(lambda q: q.state in ('error', 'dead')).write({
+            'state': 'pending',
+            'attempts': 0,
+            'next_attempt_at': False,
+        })
+
+    @api.model
+    def _cron_process_queue(self, batch_size=100, max_batches=50):
+        """Drena la cola en lotes, confirmando la transacción tras cada lote"""
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        for __ in range(max_batches):
+            batch = self._claim_batch(batch_size)
+            if not batch:
+                break
+            batch._process_batch()
+            if auto_commit:
+                self.env.cr.commit()
+            metrics.flush(self.env.registry)
+        self._gc_processed()
+        self.env['whatsapp.message.seen']._gc_seen()
+        metrics.flush(self.env.registry, force=True)
+
+    @api.model
+    def _claim_batch(self, limit):
+        """Bloquea un lote de filas pendientes sin esperar a otros workers"""
+        self.env.cr.execute("""
+            SELECT id
+            FROM whatsapp_inbound_queue
+            WHERE state IN ('pending', 'error')
+              AND (next_attempt_at IS NULL OR next_attempt_at <= (NOW() AT TIME ZONE 'UTC'))
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        """, [limit])
+        return self.browse([row[0] for row in self.env.cr.fetchall()])
+
+    def _process_batch(self):
+        """
+        Procesa todos los payloads del lote en un solo paso; si el lote
+        falla, se reprocesa fila por fila para aislar el payload con error.
+        """
+        try:
+            with self.env.cr.savepoint(), metrics.timer('queue_batch'):
+                self._process_payloads([json.loads(item.payload) for item in self])
+        except Exception as e:
+            if len(self) == 1:
+                _logger.exception("Error procesando payload de WhatsApp %s", self.id)
+                self._mark_failed(e)
+                return
+            _logger.warning("Error en lote de WhatsApp, reprocesando fila por fila", exc_info=True)
+            for item in self:
+                item._process_batch()
+        else:
+            self._mark_done()
+
+    def _mark_done(self):
+        """Marca los payloads como procesados"""
+        self.write({
+            'state': 'done',
+            'processed_at': fields.Datetime.now(),
+            'last_error': False,
+        })
+
+    def _mark_failed(self, error):
+        """Registra el error y programa el reintento con backoff exponencial"""
+        self.ensure_one()
+        attempts = self.attempts + 1
+        self.write({
+            'state': 'dead' if attempts >= MAX_ATTEMPTS else 'error',
+            'attempts': attempts,
+            'next_attempt_at': fields.Datetime.now() + timedelta(minutes=2 ** attempts),
+            'last_error': str(error),
+        })
+
+    @api.model
+    def _gc_processed(self):
+        """Elimina los payloads procesados más antiguos que la retención"""
+        self.env.cr.execute("""
+            DELETE FROM whatsapp_inbound_queue
+            WHERE state = 'done'
+              AND processed_at < (NOW() AT TIME ZONE 'UTC') - make_interval(days => %s)
+        """, [DONE_RETENTION_DAYS])
+
+    @api.model
+    def _process_payloads(self, payloads):
+        """Recorre las entradas de los payloads de Meta y procesa mensajes y estados en bloque"""
+        messages = []
+        statuses = []
+        for data in payloads:
+            for entry in data.get('entry', []):
+                for change in entry.get('changes', []):
+                    value = change.get('value', {})
+                    if 'messages' in value:
+                        messages.extend(value['messages'])
+                    elif 'statuses' in value:
+                        statuses.extend(value['statuses'])
+                    else:
+                        _logger.info(f"EVENT TYPE: OTHER ({list(value.keys())})")
+        if statuses:
+            metrics.inc('whatsapp_statuses_total', len(statuses))
+            with metrics.timer('status_ingest'):
+                self.env['whatsapp.message.status']._ingest_statuses(statuses)
+        if messages:
+            with metrics.timer('dedupe'):
+                messages = self._filter_duplicate_messages(messages)
+        if messages:
+            self._process_incoming_messages(messages)
+
+    @api.model
+    def _filter_duplicate_messages(self, messages):
+        """Descarta los mensajes cuyo wamid ya fue procesado (reenvíos de Meta)"""
+        new_ids = self.env['whatsapp.message.seen']._claim_new(m.get('id') for m in messages)
+        unique_messages = []
+        for message in messages:
+            wamid = message.get('id')
+            if wamid:
+                if wamid not in new_ids:
+                    metrics.inc('whatsapp_messages_total', result='duplicate')
+                    continue
+                new_ids.discard(wamid)
+            unique_messages.append(message)
+        return unique_messages
+
+    @api.model
+    def _process_incoming_messages(self, messages):
+        """
+        Create partners and leads for a list of messages in bulk.
+        All sender phones are resolved with one query, missing partners are
+        created with a single create(vals_list) and so are the leads.
+        Messages from a sender with an open opportunity active within the
+        threading window are appended to its chatter instead.
+        """
+        incoming = []
+        raw_keys = set()  # Números que no se pudieron normalizar
+        for message in messages:
+            phone = message.get('from')
+            body = message.get('text', {}).get('body', '')
+
+            if not body and message.get('type') == 'button':
+                body = message.get('button', {}).get('text', '')
+
+            if not phone:
+                _logger.warning("No phone number found in message")
+                continue
+            key = normalize_phone(phone)
+            if not key:
+                key = phone
+                raw_keys.add(phone)
+            incoming.append((key, phone, body))
+
+        if not incoming:
+            return self.env['crm.lead']
+
+        Partner = self.env['res.partner'].sudo()
+        Lead = self.env['crm.lead'].sudo()
+
+        # 1. Find or Create Partners (exact match on the normalized phone keys)
+        with metrics.timer('partner_resolve'):
+            partners_by_key = Partner._find_by_phone_e164({key for key, __, __ in incoming} - raw_keys)
+            if raw_keys:
+                # Sin clave E.164: coincidencia exacta con el teléfono tal como llegó,
+                # que es como se guardó al crear el contacto
+                for partner in Partner.search(['|', ('phone', 'in', list(raw_keys)), ('mobile', 'in', list(raw_keys))]):
+                    for number in (partner.phone, partner.mobile):
+                        if number in raw_keys:
+                            partners_by_key.setdefault(number, partner)
+
+            new_partner_vals = {}
+            for key, phone, __ in incoming:
+                if key not in partners_by_key and key not in new_partner_vals:
+                    new_partner_vals[key] = {
+                        'name': f'WhatsApp User {phone}',
+                        'phone': phone,
+                        'mobile': phone,
+                    }
+            if new_partner_vals:
+                new_partners = Partner.create(list(new_partner_vals.values()))
+                partners_by_key.update(zip(new_partner_vals, new_partners))
+
+        # 2. Thread each message into the sender's open opportunity, or create one
+        config = self.env['whatsapp.helper']._get_config()
+        now = fields.Datetime.now()
+        threading_enabled = config.thread_window_hours > 0
+        open_leads = {}
+        if threading_enabled:
+            with metrics.timer('thread_resolve'):
+                open_leads = Lead._find_open_whatsapp_leads(
+                    {partner.id for partner in partners_by_key.values()},
+                    now - timedelta(hours=config.thread_window_hours),
+                )
+
+        source = self.env.ref('crm.source_newsletter', raise_if_not_found=False)
+        lead_vals_by_partner = {}
+        lead_vals_list = []
+        followups = []
+        for key, phone, body in incoming:
+            partner = partners_by_key[key]
+            if threading_enabled and (partner.id in open_leads or partner.id in lead_vals_by_partner):
+                followups.append((partner, body))
+                continue
+            lead_vals = {
+                'name': f'WhatsApp: {body[:30]}...' if body else 'New WhatsApp Message',
+                'partner_id': partner.id,
+                'description': f"Message received: {body}\nPhone: {phone}",
+                'type': 'opportunity',
+                'source_id': source.id if source else False,
+                'whatsapp_last_message_at': now,
+            }
+            lead_vals_by_partner[partner.id] = lead_vals
+            lead_vals_list.append(lead_vals)
+
+        with metrics.timer('lead_create'):
+            new_leads = Lead.create(lead_vals_list)
+        if threading_enabled:
+            open_leads.update(zip(lead_vals_by_partner, new_leads))
+
+        if followups:
+            with metrics.timer('thread_append'):
+                threaded_leads = Lead
+                for partner, body in followups:
+                    lead = open_leads[partner.id]
+                    lead._post_whatsapp_inbound(body, partner)
+                    threaded_leads |= lead
+                threaded_leads.write({'whatsapp_last_message_at': now})
+
+        metrics.inc('whatsapp_messages_total', len(incoming), result='processed')
+        log_event(_logger, 'whatsapp_messages_processed', messages=len(messages),
+                  new_partners=len(new_partner_vals), leads=len(new_leads), threaded=len(followups))
+        return new_leads
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from collections import OrderedDict
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+# Días que se conservan los ids procesados (Meta reintenta hasta 7 días)
+SEEN_RETENTION_DAYS = 7
+
+
+class _SeenCache:
+    """LRU en memoria de ids de mensaje ya registrados, compartido por los hilos del worker"""
+
+    def __init__(self, maxsize=50000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return True
+            return False
+
+    def add_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data[key] = True
+                self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+seen_cache = _SeenCache()
+
+
+def extract_message_ids(data):
+    """Devuelve los wamid de los mensajes contenidos en un payload de Meta"""
+    return [
+        message['id']
+        for entry in data.get('entry', [])
+        for change in entry.get('changes', [])
+        for message in change.get('value', {}).get('messages', [])
+        if message.get('id')
+    ]
+
+
+class WhatsAppMessageSeen(models.Model):
+    """Registro de mensajes de WhatsApp ya recibidos, para ignorar reenvíos de Meta"""
+    _name = 'whatsapp.message.seen'
+    _description = 'Mensajes de WhatsApp Recibidos'
+    _log_access = False
+
+    wamid = fields.Char(string='ID de Mensaje', required=True, readonly=True)
+    received_at = fields.Datetime(string='Recibido el', required=True, index=True, readonly=True,
+                                  default=fields.Datetime.now)
+
+    _sql_constraints = [
+        ('wamid_unique', 'UNIQUE(wamid)', 'El mensaje de WhatsApp ya fue registrado.'),
+    ]
+
+    @api.model
+    def _is_cached(self, wamids):
+        """True si todos los ids ya están en la caché del worker (sin tocar la base de datos)"""
+        dbname = self.env.cr.dbname
+        return bool(wamids) and all((dbname, wamid) in seen_cache for wamid in wamids)
+
+    @api.model
+    def _cache_after_commit(self, wamids):
+        """Agrega los ids a la caché solo cuando la transacción se confirme"""
+        keys = [(self.env.cr.dbname, wamid) for wamid in wamids]
+        if keys:
+            self.env.cr.postcommit.add(lambda: seen_cache.add_many(keys))
+
+    @api.model
+    def _claim_new(self, wamids):
+        """
+        Registra los ids y devuelve solo los que no se habían visto
+
+        Un único INSERT ... ON CONFLICT DO NOTHING resuelve el lote completo,
+        también entre workers concurrentes.
+        """
+        wamids = list(dict.fromkeys(wamid for wamid in wamids if wamid))
+        if not wamids:
+            return set()
+        self.env.cr.execute("""
+            INSERT INTO whatsapp_message_seen (wamid, received_at)
+            SELECT UNNEST(%s::varchar[]), NOW() AT TIME ZONE 'UTC'
+            ON CONFLICT (wamid) DO NOTHING
+            RETURNING wamid
+        """, [wamids])
+        new_ids = {row[0] for row in self.env.cr.fetchall()}
+        self._cache_after_commit(wamids)
+        return new_ids
+
+    @api.model
+    def _gc_seen(self):
+        """Elimina los ids fuera de la ventana de retención"""
+        self.env.cr.execute("""
+            DELETE FROM whatsapp_message_seen
+            WHERE received_at < (NOW() AT TIME ZONE 'UTC') - make_interval(days => %s)
+        """, [SEEN_RETENTION_DAYS])
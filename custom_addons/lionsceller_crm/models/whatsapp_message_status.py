@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+import logging
+from datetime import datetime, timezone
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+# Orden de los estados de Meta; un estado nunca retrocede
+STATUS_ORDER = ['sent', 'delivered', 'read', 'failed']
+
+
+def _status_datetime(timestamp):
+    """Convierte el timestamp UNIX de Meta a datetime UTC sin zona (formato del ORM)"""
+    try:
+        return datetime.fromtimestamp(int(timestamp), tz=timezone.utc).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return fields.Datetime.now()
+
+
+class WhatsAppMessageStatus(models.Model):
+    """Último estado de entrega de cada mensaje saliente de WhatsApp
+
+    Una fila por wamid con el estado más avanzado y la fecha de cada
+    transición; los callbacks de Meta se aplican con upserts por lote.
+    """
+    _name = 'whatsapp.message.status'
+    _description = 'Estado de Entrega de WhatsApp'
+    _log_access = False
+    _order = 'id desc'
+    _rec_name = 'wamid'
+
+    wamid = fields.Char(string='ID de Mensaje', required=True, readonly=True)
+    state = fields.Selection([
+        ('sent', 'Enviado'),
+        ('delivered', 'Entregado'),
+        ('read', 'Leído'),
+        ('failed', 'Fallido'),
+    ], string='Estado', readonly=True)
+    lead_id = fields.Many2one('crm.lead', string='Lead/Oportunidad', ondelete='set null',
+                              index='btree_not_null', readonly=True)
+    campaign_id = fields.Many2one('whatsapp.campaign', string='Campaña', ondelete='set null',
+                                  index='btree_not_null', readonly=True)
+    user_id = fields.Many2one('res.users', string='Asesor', ondelete='set null',
+                              index='btree_not_null', readonly=True)
+    sent_at = fields.Datetime(string='Enviado el', readonly=True)
+    delivered_at = fields.Datetime(string='Entregado el', readonly=True)
+    read_at = fields.Datetime(string='Leído el', readonly=True)
+    failed_at = fields.Datetime(string='Fallido el', readonly=True)
+    error = fields.Char(string='Error', readonly=True)
+
+    # Indicadores 0/1 para sumar tasas en pivot/read_group sin leer eventos
+    message_count = fields.Integer(string='Mensajes', default=1, readonly=True, aggregator='sum')
+    delivered_count = fields.Integer(string='Entregados', default=0, readonly=True, aggregator='sum')
+    read_count = fields.Integer(string='Leídos', default=0, readonly=True, aggregator='sum')
+    failed_count = fields.Integer(string='Fallidos', default=0, readonly=True, aggregator='sum')
+
+    _sql_constraints = [
+        ('wamid_unique', 'UNIQUE(wamid)', 'El mensaje de WhatsApp ya tiene estado registrado.'),
+    ]
+
+    @api.model
+    def _register_outbound(self, rows):
+        """
+        Registra los mensajes enviados con su lead, campaña y asesor
+
+        :param rows: lista de dicts con wamid, lead_id, campaign_id, user_id
+        """
+        rows = [row for row in rows if row.get('wamid')]
+        if not rows:
+            return
+        self.env.cr.execute("""
+            INSERT INTO whatsapp_message_status AS s (
+                wamid, state, lead_id, campaign_id, user_id, sent_at,
+                message_count, delivered_count, read_count, failed_count
+            )
+            SELECT v.wamid, 'sent', v.lead_id, v.campaign_id, v.user_id, NOW() AT TIME ZONE 'UTC', 1, 0, 0, 0
+            FROM (
+                SELECT UNNEST(%s::varchar[]) AS wamid,
+                       UNNEST(%s::int[]) AS lead_id,
+                       UNNEST(%s::int[]) AS campaign_id,
+                       UNNEST(%s::int[]) AS user_id
+            ) v
+            ON CONFLICT (wamid) DO UPDATE SET
+                lead_id = EXCLUDED.lead_id,
+                campaign_id = EXCLUDED.campaign_id,
+                user_id = EXCLUDED.user_id,
+                sent_at = COALESCE(s.sent_at, EXCLUDED.sent_at)
+        """, [
+            [row['wamid'] for row in rows],
+            [row.get('lead_id') or None for row in rows],
+            [row.get('campaign_id') or None for row in rows],
+            [row.get('user_id') or None for row in rows],
+        ])
+        self.invalidate_model()
+
+    @api.model
+    def _ingest_statuses(self, statuses):
+        """
+        Aplica un lote de callbacks `statuses` de Meta con un solo upsert
+
+        Los eventos del mismo mensaje se combinan antes de escribir; el
+        estado solo avanza y cada fecha se guarda la primera vez.
+        """
+        merged = {}
+        for status in statuses:
+            wamid = status.get('id')
+            state = status.get('status')
+            if not wamid or state not in STATUS_ORDER:
+                continue
+            row = merged.setdefault(wamid, {'state': state})
+            if STATUS_ORDER.index(state) > STATUS_ORDER.index(row['state']):
+                row['state'] = state
+            row.setdefault(f'{state}_at', _status_datetime(status.get('timestamp')))
+            if state == 'failed':
+                errors = status.get('errors') or [{}]
+                row['error'] = (errors[0].get('title') or errors[0].get('message') or '')[:255]
+        if not merged:
+            return
+
+        wamids = list(merged)
+        self.env.cr.execute("""
+            INSERT INTO whatsapp_message_status AS s (
+                wamid, state, sent_at, delivered_at, read_at, failed_at, error,
+                message_count, delivered_count, read_count, failed_count
+            )
+            SELECT v.wamid, v.state, v.sent_at, v.delivered_at, v.read_at, v.failed_at, v.error,
+                   1,
+                   (v.state IN ('delivered', 'read'))::int,
+                   (v.state = 'read')::int,
+                   (v.state = 'failed')::int
+            FROM (
+                SELECT UNNEST(%s::varchar[]) AS wamid,
+                       UNNEST(%s::varchar[]) AS state,
+                       UNNEST(%s::timestamp[]) AS sent_at,
+                       UNNEST(%s::timestamp[]) AS delivered_at,
+                       UNNEST(%s::timestamp[]) AS read_at,
+                       UNNEST(%s::timestamp[]) AS failed_at,
+                       UNNEST(%s::varchar[]) AS error
+            ) v
+            ON CONFLICT (wamid) DO UPDATE SET
+                state = CASE
+                    WHEN s.state IS NULL
+                      OR array_position(%s::varchar[], EXCLUDED.state) > array_position(%s::varchar[], s.state)
+                    THEN EXCLUDED.state ELSE s.state END,
+                sent_at = COALESCE(s.sent_at, EXCLUDED.sent_at),
+                delivered_at = COALESCE(s.delivered_at, EXCLUDED.delivered_at),
+                read_at = COALESCE(s.read_at, EXCLUDED.read_at),
+                failed_at = COALESCE(s.failed_at, EXCLUDED.failed_at),
+                error = COALESCE(EXCLUDED.error, s.error),
+                delivered_count = GREATEST(s.delivered_count, EXCLUDED.delivered_count),
+                read_count = GREATEST(s.read_count, EXCLUDED.read_count),
+                failed_count = GREATEST(s.failed_count, EXCLUDED.failed_count)
+        """, [
+            wamids,
+            [merged[w]['state'] for w in wamids],
+            [merged[w].get('sent_at') for w in wamids],
+            [merged[w].get('delivered_at') for w in wamids],
+            [merged[w].get('read_at') for w in wamids],
+            [merged[w].get('failed_at') for w in wamids],
+            [merged[w].get('error') for w in wamids],
+            STATUS_ORDER,
+            STATUS_ORDER,
+        ])
+        self.invalidate_model()
+        _logger.debug("WhatsApp statuses aplicados: %s eventos, %s mensajes", len(statuses), len(wamids))
+
+    @api.model
+    def get_delivery_rates(self, groupby='campaign_id', domain=None):
+        """
+        Tasas de entrega y lectura agrupadas por lead, campaña o asesor
+
+        :param groupby: 'lead_id', 'campaign_id' o 'user_id'
+        :return: lista de dicts con conteos y porcentajes
+        """
+        groups = self._read_group(
+            (domain or []) + [(groupby, '!=', False)],
+            [groupby],
+            ['message_count:sum', 'delivered_count:sum', 'read_count:sum', 'failed_count:sum'],
+        )
+        result = []
+        for record, total, delivered, read, failed in groups:
+            result.append({
+                groupby: record.id,
+                'name': record.display_name,
+                'messages': total,
+                'delivered': delivered,
+                'read': read,
+                'failed': failed,
+                'delivery_rate': round(100.0 * delivered / total, 2) if total else 0.0,
+                'read_rate': round(100.0 * read / total, 2) if total else 0.0,
+            })
+        return result
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Métricas y logging estructurado del flujo de WhatsApp
+
+Contadores e histogramas con un timer por etapa. Cada proceso acumula sus
+muestras en memoria, por base de datos, y las suma periódicamente a la
+tabla whatsapp_metric; /whatsapp/metrics exporta esa tabla en formato
+Prometheus, así incluye lo medido por los workers HTTP y los de cron.
+También un logger de eventos JSON con muestreo y payloads truncados y
+enmascarados.
+"""
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from odoo.tools import SQL
+
+_logger = logging.getLogger(__name__)
+
+# Límites de los buckets de los histogramas, en milisegundos
+BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Tabla con los totales de todos los procesos
+METRICS_TABLE = 'whatsapp_metric'
+# Segundos entre volcados de un proceso a la tabla
+FLUSH_INTERVAL = 10
+
+_PHONE_RE = re.compile(r'\d{7,}')
+
+
+def _current_dbname():
+    """Base de datos de la petición o del cron en curso (Odoo la fija en el hilo)"""
+    return getattr(threading.current_thread(), 'dbname', None)
+
+
+class MetricsRegistry:
+    """Contadores e histogramas con etiquetas, seguros entre hilos
+
+    Guarda solo lo medido desde el último volcado; los totales viven en
+    METRICS_TABLE.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._last_flush = defaultdict(float)
+
+    @staticmethod
+    def _key(name, labels):
+        return _current_dbname(), name, json.dumps(labels, sort_keys=True)
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[self._key(name, labels)] += value
+
+    def observe(self, name, value_ms, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(BUCKETS_MS), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(BUCKETS_MS):
+                if value_ms <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value_ms
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, stage):
+        """Mide la duración de una etapa en whatsapp_stage_duration_ms{stage=...}"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('whatsapp_stage_duration_ms', (time.perf_counter() - start) * 1000.0, stage=stage)
+
+    def _take(self, dbname):
+        """Saca las muestras pendientes de una base de datos (y las medidas fuera de una)"""
+        with self._lock:
+            counters = {k: v for k, v in self._counters.items() if k[0] in (dbname, None)}
+            histograms = {k: v for k, v in self._histograms.items() if k[0] in (dbname, None)}
+            for key in counters:
+                del self._counters[key]
+            for key in histograms:
+                del self._histograms[key]
+            self._last_flush[dbname] = time.monotonic()
+        return counters, histograms
+
+    def flush(self, db_registry, force=False):
+        """
+        Suma las muestras de este proceso a METRICS_TABLE
+
+        Usa su propio cursor: no depende de que la transacción en curso se
+        confirme. Sin `force` solo vuelca cada FLUSH_INTERVAL segundos.
+        """
+        dbname = db_registry.db_name
+        if not force and time.monotonic() - self._last_flush[dbname] < FLUSH_INTERVAL:
+            return
+        counters, histograms = self._take(dbname)
+        if not counters and not histograms:
+            return
+        rows = [(name, labels, value, 0.0, None) for (__, name, labels), value in counters.items()]
+        rows += [
+            (name, labels, h['count'], h['sum'], h['buckets'])
+            for (__, name, labels), h in histograms.items()
+        ]
+        try:
+            with db_registry.cursor() as cr:
+                cr.execute(SQL("""
+                    INSERT INTO %s AS m (name, labels, value, sum, buckets)
+                    SELECT v.name, v.labels, v.value, v.sum,
+                           CASE WHEN jsonb_typeof(v.buckets) = 'array' THEN
+                               ARRAY(SELECT e::float8 FROM jsonb_array_elements_text(v.buckets)
+                                     WITH ORDINALITY AS b(e, i) ORDER BY i)
+                           END
+                    FROM jsonb_to_recordset(%s::jsonb)
+                        AS v(name varchar, labels varchar, value float8, sum float8, buckets jsonb)
+                    ORDER BY v.name, v.labels
+                    ON CONFLICT (name, labels) DO UPDATE SET
+                        value = m.value + EXCLUDED.value,
+                        sum = m.sum + EXCLUDED.sum,
+                        buckets = (
+                            SELECT array_agg(COALESCE(a, 0) + COALESCE(b, 0) ORDER BY i)
+                            FROM unnest(m.buckets, EXCLUDED.buckets) WITH ORDINALITY AS x(a, b, i)
+                        )
+                """, SQL.identifier(METRICS_TABLE), json.dumps([
+                    {'name': name, 'labels': labels, 'value': value, 'sum': total, 'buckets': buckets}
+                    for name, labels, value, total, buckets in rows
+                ])))
+        except Exception:
+            _logger.warning("No se pudieron guardar las métricas de WhatsApp", exc_info=True)
+
+    def render_prometheus(self, cr):
+        """Exporta en formato de texto de Prometheus los totales de METRICS_TABLE"""
+        def fmt_labels(labels, extra=()):
+            items = sorted(json.loads(labels).items()) + list(extra)
+            if not items:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in items)
+
+        cr.execute(SQL("SELECT name, labels, value, sum, buckets FROM %s ORDER BY name, labels",
+                       SQL.identifier(METRICS_TABLE)))
+        lines = []
+        seen = set()
+        for name, labels, value, total, buckets in cr.fetchall():
+            if buckets is None:
+                if name not in seen:
+                    lines.append('# TYPE %s counter' % name)
+                    seen.add(name)
+                lines.append('%s%s %s' % (name, fmt_labels(labels), value))
+                continue
+            if name not in seen:
+                lines.append('# TYPE %s histogram' % name)
+                seen.add(name)
+            for bound, count in zip(BUCKETS_MS, buckets):
+                lines.append('%s_bucket%s %s' % (name, fmt_labels(labels, [('le', bound)]), count))
+            lines.append('%s_bucket%s %s' % (name, fmt_labels(labels, [('le', '+Inf')]), value))
+            lines.append('%s_sum%s %s' % (name, fmt_labels(labels), total))
+            lines.append('%s_count%s %s' % (name, fmt_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def redact_payload(text, max_length=512):
+    """Enmascara números de teléfono y trunca el payload para el log"""
+    if text is None:
+        return ''
+    if not isinstance(text, str):
+        text = json.dumps(text, ensure_ascii=False, default=str)
+    text = _PHONE_RE.sub(lambda m: '*' * (len(m.group()) - 4) + m.group()[-4:], text)
+    if max_length and len(text) > max_length:
+        text = '%s...(+%s chars)' % (text[:max_length], len(text) - max_length)
+    return text
+
+
+def log_event(logger, event, sample_rate=1.0, level=logging.INFO, **fields):
+    """Escribe un evento como una línea JSON, solo para la fracción `sample_rate`"""
+    if not logger.isEnabledFor(level):
+        return
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return
+    fields['event'] = event
+    logger.log(level, json.dumps(fields, ensure_ascii=False, default=str, sort_keys=True))
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from datetime import timedelta
+
+from odoo import api, fields, models, _
+from odoo.exceptions import AccessError
+
+from .whatsapp_sender import backoff_delay, message_id
+
+_logger = logging.getLogger(__name__)
+
+# Intentos antes de descartar un mensaje
+MAX_ATTEMPTS = 6
+# Minutos tras los que un mensaje que quedó 'enviando' se da por interrumpido
+SENDING_TIMEOUT_MINUTES = 15
+
+
+class WhatsAppOutbox(models.Model):
+    """Bandeja de salida de WhatsApp
+
+    send_message solo inserta aquí el mensaje; un cron lo envía fuera de la
+    transacción del usuario, con límite de tasa y reintentos.
+    """
+    _name = 'whatsapp.outbox'
+    _description = 'Bandeja de Salida de WhatsApp'
+    _order = 'id desc'
+
+    phone = fields.Char(string='Teléfono', required=True, readonly=True)
+    message = fields.Text(string='Mensaje', required=True, readonly=True)
+    partner_id = fields.Many2one('res.partner', string='Contacto', ondelete='set null', readonly=True)
+    lead_id = fields.Many2one('crm.lead', string='Lead/Oportunidad', ondelete='set null',
+                              index='btree_not_null', readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pendiente'),
+        ('sending', 'Enviando'),
+        ('error', 'Error (reintentando)'),
+        ('sent', 'Enviado'),
+        ('dead', 'Fallido'),
+    ], string='Estado', default='pending', required=True, index=True, readonly=True)
+    attempts = fields.Integer(string='Intentos', default=0, readonly=True)
+    next_attempt_at = fields.Datetime(string='Próximo Intento', readonly=True)
+    sent_at = fields.Datetime(string='Enviado el', readonly=True)
+    wamid = fields.Char(string='ID de Mensaje', index='btree_not_null', readonly=True)
+    last_error = fields.Text(string='Último Error', readonly=True)
+
+    @api.model
+    def enqueue(self, phone, message, partner_id=None, lead_id=None):
+        """Agrega un mensaje a la bandeja y despierta al cron de envío"""
+        record = self.sudo().create({
+            'phone': phone,
+            'message': message,
+            'partner_id': partner_id or False,
+            'lead_id': lead_id or False,
+        })
+        cron = self.env.ref('lionsceller_crm.ir_cron_whatsapp_outbox', raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+        return record
+
+    def action_retry(self):
+        """Vuelve a poner en cola los mensajes fallidos"""
+        # Los gerentes solo leen la bandeja; el reintento se escribe con sudo
+        if not self.env.user.has_group('sales_team.group_sale_manager'):
+            raise AccessError(_("Solo los gerentes de ventas pueden reintentar mensajes."))
+        self.sudo().filtered(lambda o: o.state in ('error', 'dead')).write({
+            'state': 'pending',
+            'attempts': 0,
+            'next_attempt_at': False,
+        })
+        cron = self.env.ref('lionsceller_crm.ir_cron_whatsapp_outbox', raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+
+    @api.model
+    def _cron_send_outbox(self, batch_size=100, max_batches=20):
+        """
+        Envía los mensajes pendientes por lotes
+
+        El lote se marca 'enviando' y se confirma antes de las llamadas HTTP;
+        luego cada resultado se confirma tras su envío. Si el worker muere a
+        mitad del lote, los mensajes ya entregados quedan como enviados y los
+        que estaban en vuelo no se reenvían solos.
+        """
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        self._release_stale_sending()
+        for __ in range(max_batches):
+            batch = self._claim_batch(batch_size)
+            if not batch:
+                break
+            if auto_commit:
+                self.env.cr.commit()
+            for item in batch:
+                item._send()
+                if auto_commit:
+                    self.env.cr.commit()
+
+    @api.model
+    def _release_stale_sending(self):
+        """
+        Descarta los mensajes que quedaron 'enviando' por un worker caído
+
+        Pudieron entregarse o no: quedan como fallidos para reintentarlos a
+        mano en lugar de arriesgar un duplicado.
+        """
+        stale = self.search([
+            ('state', '=', 'sending'),
+            ('write_date', '<', fields.Datetime.now() - timedelta(minutes=SENDING_TIMEOUT_MINUTES)),
+        ])
+        if stale:
+            stale.write({
+                'state': 'dead',
+                'last_error': _("Envío interrumpido: el mensaje pudo haberse entregado. Verifique antes de reintentar."),
+            })
+            _logger.warning("Bandeja de WhatsApp: %s mensajes interrumpidos durante el envío", len(stale))
+
+    @api.model
+    def _claim_batch(self, limit):
+        """Toma un lote de mensajes listos sin esperar a otros workers y lo marca 'enviando'"""
+        self.env.cr.execute("""
+            SELECT id
+            FROM whatsapp_outbox
+            WHERE state IN ('pending', 'error')
+              AND (next_attempt_at IS NULL OR next_attempt_at <= (NOW() AT TIME ZONE 'UTC'))
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        """, [limit])
+        batch = self.browse([row[0] for row in self.env.cr.fetchall()])
+        batch.write({'state': 'sending'})
+        return batch
+
+    def _send(self):
+        """Envía cada mensaje y registra el resultado"""
+        helper = self.env['whatsapp.helper']
+        sent = []
+        for item in self:
+            result = helper._send_now(item.phone, item.message)
+            if result['success']:
+                item.write({
+                    'state': 'sent',
+                    'sent_at': fields.Datetime.now(),
+                    'wamid': message_id(result['response']),
+                    'last_error': False,
+                })
+                sent.append({
+                    'wamid': item.wamid,
+                    'lead_id': item.lead_id.id,
+                    'user_id': item.lead_id.user_id.id,
+                })
+                if item.lead_id:
+                    item.lead_id.message_post(
+                        body=_("📱 Mensaje de WhatsApp enviado:<br/><i>%s</i>") % item.message,
+                        message_type='comment',
+                        subtype_xmlid='mail.mt_note'
+                    )
+            else:
+                item._mark_failed(result['message'], result['retryable'])
+        self.env['whatsapp.message.status']._register_outbound(sent)
+
+    def _mark_failed(self, error, retryable):
+        """Programa el reintento con backoff y jitter, o descarta el mensaje"""
+        self.ensure_one()
+        attempts = self.attempts + 1
+        dead = not retryable or attempts >= MAX_ATTEMPTS
+        self.write({
+            'state': 'dead' if dead else 'error',
+            'attempts': attempts,
+            'next_attempt_at': fields.Datetime.now() + timedelta(seconds=60 * backoff_delay(attempts, base=1, cap=60)),
+            'last_error': error,
+        })
+        if dead and self.lead_id:
+            self.lead_id.message_post(
+                body=_("❌ No se pudo enviar el mensaje de WhatsApp a %s:<br/><i>%s</i>") % (self.phone, error),
+                message_type='comment',
+                subtype_xmlid='mail.mt_note'
+            )
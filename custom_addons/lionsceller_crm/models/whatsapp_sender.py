@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Cliente HTTP para Meta Cloud API
+
+Mantiene una sesión con conexiones keep-alive reutilizables, limita el
+envío por número de WhatsApp con un token bucket y reintenta los errores
+transitorios con backoff exponencial y jitter. No usa el ORM, por lo que
+puede llamarse desde hilos de trabajo.
+"""
+import logging
+import random
+import threading
+import time
+from collections import namedtuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_API_URL = 'https://graph.facebook.com/v18.0'
+# Mensajes por segundo por número según el nivel de Meta
+DEFAULT_MESSAGES_PER_SECOND = 80
+# Respuestas de Meta que vale la pena reintentar
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+SendResult = namedtuple('SendResult', ['success', 'response', 'error', 'retryable'])
+
+_session = None
+_session_lock = threading.Lock()
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class TokenBucket:
+    """Limitador de tasa: `rate` mensajes por segundo con ráfagas de hasta `capacity`"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Bloquea hasta que haya `tokens` disponibles"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def get_session():
+    """Sesión compartida con pool de conexiones keep-alive"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+def get_bucket(phone_number_id, rate):
+    """Token bucket del número emisor (uno por proceso)"""
+    with _buckets_lock:
+        bucket = _buckets.get(phone_number_id)
+        if bucket is None or bucket.rate != float(rate):
+            bucket = _buckets[phone_number_id] = TokenBucket(rate)
+        return bucket
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """Backoff exponencial con jitter completo, en segundos"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def post_message(phone_number_id, access_token, payload, api_url=DEFAULT_API_URL,
+                 rate=DEFAULT_MESSAGES_PER_SECOND, timeout=10, max_retries=2):
+    """
+    Envía un payload al endpoint /messages de Meta Cloud API
+
+    :param api_url: URL base del Graph API (permite apuntar a un servidor local de pruebas)
+    :param rate: mensajes por segundo permitidos para el número emisor
+    :param max_retries: reintentos inmediatos ante errores transitorios
+    :return: SendResult(success, response, error, retryable)
+    """
+    url = f"{api_url.rstrip('/')}/{phone_number_id}/messages"
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json',
+    }
+    bucket = get_bucket(phone_number_id, rate)
+
+    for attempt in range(max_retries + 1):
+        bucket.acquire()
+        response_data = {}
+        try:
+            response = get_session().post(url, headers=headers, json=payload, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            error, retryable = str(e), True
+        else:
+            try:
+                response_data = response.json()
+            except ValueError:
+                response_data = {'error': {'message': response.text[:500]}}
+            if response.status_code == 200:
+                return SendResult(True, response_data, '', False)
+            error = response_data.get('error', {}).get('message', 'Error desconocido')
+            retryable = response.status_code in RETRYABLE_STATUS
+
+        if not retryable or attempt == max_retries:
+            break
+        delay = backoff_delay(attempt)
+        _logger.warning("Error transitorio enviando WhatsApp (%s), reintento en %.1fs", error, delay)
+        time.sleep(delay)
+
+    return SendResult(False, response_data, error, retryable)
+
+
+def message_id(response_data):
+    """wamid asignado por Meta al mensaje enviado"""
+    messages = (response_data or {}).get('messages') or [{}]
+    return messages[0].get('id')
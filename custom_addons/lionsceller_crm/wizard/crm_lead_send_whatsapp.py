@@ -51,7 +51,11 @@ class CrmLeadSendWhatsApp(models.TransientModel):
                 'tag': 'display_notification',
                 'params': {
                     'title': _('¡WhatsApp Enviado!'),
-                    'message': _('El mensaje fue enviado exitosamente a %s') % self.phone,
+                    'message': (
+                        _('El mensaje a %s quedó en cola y se enviará en unos segundos') % self.phone
+                        if result.get('queued') else
+                        _('El mensaje fue enviado exitosamente a %s') % self.phone
+                    ),
                     'type': 'success',
                     'sticky': False,
                 }